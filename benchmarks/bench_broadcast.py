@@ -0,0 +1,72 @@
+"""Бенчмарк движка рассылки на локальном фейковом боте.
+
+Фейковый бот добавляет задержку к каждому запросу и с заданной вероятностью
+отвечает 429 (TelegramRetryAfter), как это делает Telegram под нагрузкой.
+
+    python benchmarks/bench_broadcast.py --users 2000 --latency 0.05 --retry-rate 0.01
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_API_TOKEN", "123456:BENCHMARK-TOKEN")
+# bot.py создаёт каталог data и bot.log в текущей директории
+os.chdir(tempfile.mkdtemp(prefix="bench_broadcast_"))
+
+from aiogram.exceptions import TelegramRetryAfter  # noqa: E402
+from aiogram.methods import SendMessage  # noqa: E402
+
+import bot as bot_module  # noqa: E402
+
+class FakeBot:
+    def __init__(self, latency: float, retry_rate: float, retry_after: int):
+        self.latency = latency
+        self.retry_rate = retry_rate
+        self.retry_after = retry_after
+        self.delivered = set()
+        self.calls = 0
+        self.rejected = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if random.random() < self.retry_rate:
+            self.rejected += 1
+            raise TelegramRetryAfter(
+                method=SendMessage(chat_id=chat_id, text=text),
+                message="Too Many Requests",
+                retry_after=self.retry_after
+            )
+        self.delivered.add(chat_id)
+
+async def run(args):
+    fake_bot = FakeBot(args.latency, args.retry_rate, args.retry_after)
+    engine = bot_module.BroadcastEngine(
+        fake_bot, rate=args.rate, concurrency=args.concurrency
+    )
+    result = await engine.run(range(args.users), "benchmark", parse_mode="HTML")
+
+    print(f"получателей:      {args.users}")
+    print(f"доставлено:       {len(fake_bot.delivered)} (sent={result.sent}, failed={result.failed})")
+    print(f"запросов к API:   {fake_bot.calls}, из них 429: {fake_bot.rejected}")
+    print(f"повторов:         {result.retries}")
+    print(f"время:            {result.elapsed:.2f} сек")
+    print(f"скорость:         {result.rate:.1f} сообщ./сек (лимит {args.rate})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=bot_module.BROADCAST_RATE)
+    parser.add_argument("--concurrency", type=int, default=bot_module.BROADCAST_CONCURRENCY)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--retry-rate", type=float, default=0.01)
+    parser.add_argument("--retry-after", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
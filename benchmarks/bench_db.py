@@ -0,0 +1,90 @@
+"""Микро-бенчмарк записи в SQLite: соединение на каждый запрос против Database.
+
+Меряет число записей в секунду и максимальную задержку event loop,
+пока обработчики пишут last_activity.
+
+    python benchmarks/bench_db.py --writes 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_API_TOKEN", "123456:BENCHMARK-TOKEN")
+os.chdir(tempfile.mkdtemp(prefix="bench_db_"))
+
+import bot as bot_module  # noqa: E402
+
+USERS = 1000
+# Отдельный файл в режиме журнала по умолчанию, как было до Database
+LEGACY_DB_FILE = os.path.join(bot_module.DATA_DIR, "legacy.db")
+
+async def write_per_connection(user_id: int):
+    """Прежняя реализация: connect, UPDATE, commit и close в потоке event loop."""
+    conn = sqlite3.connect(LEGACY_DB_FILE)
+    try:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        conn.execute('UPDATE users SET last_activity = ? WHERE user_id = ?', (now, user_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+async def write_database(user_id: int):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    await bot_module.db.execute('UPDATE users SET last_activity = ? WHERE user_id = ?', (now, user_id))
+
+async def measure(write, writes: int, concurrency: int):
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def monitor():
+        nonlocal lag
+        while not done.is_set():
+            before = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag = max(lag, time.perf_counter() - before - 0.001)
+
+    async def writer(offset: int):
+        for i in range(offset, writes, concurrency):
+            await write(i % USERS)
+
+    monitor_task = asyncio.create_task(monitor())
+    started = time.perf_counter()
+    await asyncio.gather(*(writer(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await monitor_task
+    return writes / elapsed, lag * 1000
+
+async def run(args):
+    conn = sqlite3.connect(LEGACY_DB_FILE)
+    conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, last_activity TEXT)')
+    conn.executemany('INSERT INTO users (user_id) VALUES (?)', [(i,) for i in range(USERS)])
+    conn.commit()
+    conn.close()
+
+    await bot_module.init_db()
+    await bot_module.db.executemany(
+        'INSERT OR IGNORE INTO users (user_id) VALUES (?)', [(i,) for i in range(USERS)]
+    )
+
+    for name, write in (("соединение на запрос", write_per_connection), ("Database (WAL)", write_database)):
+        rate, lag = await measure(write, args.writes, args.concurrency)
+        print(f"{name:22} {rate:10.0f} записей/сек   макс. задержка loop {lag:8.1f} мс")
+
+    await bot_module.db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
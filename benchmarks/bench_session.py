@@ -0,0 +1,77 @@
+"""Бенчмарк пула соединений Bot API.
+
+Отправляет --requests запросов sendMessage на фейковый Bot API
+(benchmarks/fake_telegram.py) сначала через сессию aiogram по умолчанию
+(пул на 100 соединений), затем через сессию бота с пулом HTTP_POOL_SIZE.
+Параллельных запросов по умолчанию столько же, сколько у бота обработчиков
+обновлений и отправителей рассылки; когда их больше, чем соединений в пуле,
+лишние запросы ждут свободного соединения, и это видно по p50/p99.
+
+    python benchmarks/bench_session.py --requests 5000 --latency 0.2
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from load_test import bot_module, fetch_stats, percentiles, start_fake_server
+
+async def run_session(name: str, session, url: str, args):
+    async with aiohttp.ClientSession() as client:
+        async with client.post(f"{url}/reset"):
+            pass
+    bot = Bot(token=bot_module.API_TOKEN, session=session)
+    chat_ids = iter(range(1, args.requests + 1))
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for chat_id in chat_ids:
+            started = time.perf_counter()
+            try:
+                await bot.send_message(chat_id, "benchmark")
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    await bot.session.close()
+
+    stats = await fetch_stats(url)
+    p50, p99 = percentiles(latencies)
+    print(
+        f"{name:<8} соединений {stats['connections']:>4}  ошибок {errors:>4}  "
+        f"{len(latencies) / elapsed:8.1f} запр./сек  p50 {p50:7.1f} мс  p99 {p99:7.1f} мс"
+    )
+
+async def run(args):
+    process, url = await start_fake_server(args)
+    try:
+        print(f"запросов {args.requests}, параллельно {args.concurrency}, задержка API {args.latency * 1000:.0f} мс")
+        await run_session("default", AiohttpSession(api=TelegramAPIServer.from_base(url)), url, args)
+        await run_session("bot", bot_module.create_bot_session(url, args.pool), url, args)
+    finally:
+        process.terminate()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int,
+                        default=bot_module.WORKER_CONCURRENCY + bot_module.BROADCAST_CONCURRENCY)
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка ответа фейкового API, сек")
+    parser.add_argument("--pool", type=int, default=bot_module.HTTP_POOL_SIZE, help="пул сессии бота")
+    args = parser.parse_args()
+    # Параметры фейкового API, которые ожидает start_fake_server из load_test
+    args.retry_rate, args.retry_after, args.blocked_rate = 0.0, 1, 0.0
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
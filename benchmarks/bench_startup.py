@@ -0,0 +1,68 @@
+"""Бенчмарк времени запуска бота на основе python -X importtime.
+
+Импортирует bot.py в отдельном процессе, печатает суммарное время импорта
+и самые тяжёлые модули. Проверяет, что модуль отчётов не грузится при старте.
+
+    python benchmarks/bench_startup.py --runs 5 --max-ms 1500
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Модули, которые должны загружаться только по запросу администратора
+LAZY_MODULES = ("reports", "xlsxwriter", "pandas")
+
+def import_times() -> dict:
+    """Возвращает {модуль: накопленное время импорта в мкс} для одного запуска."""
+    env = dict(os.environ, BOT_API_TOKEN="123456:BENCHMARK-TOKEN", PYTHONPATH=ROOT)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import bot"],
+        cwd=tempfile.mkdtemp(prefix="bench_startup_"),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, help="завершиться с ошибкой, если медиана больше")
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    totals = [run["bot"] / 1000 for run in runs]
+    median = statistics.median(totals)
+    print(f"import bot: медиана {median:.0f} мс, мин {min(totals):.0f} мс, макс {max(totals):.0f} мс")
+
+    print("\nСамые тяжёлые модули верхнего уровня (последний запуск):")
+    last = runs[-1]
+    top_level = {name: us for name, us in last.items() if "." not in name and name != "bot"}
+    for name, us in sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {name:25} {us / 1000:8.1f} мс")
+
+    failed = False
+    loaded = [name for name in LAZY_MODULES if name in last]
+    if loaded:
+        print(f"\nОШИБКА: при запуске загружаются {', '.join(loaded)}")
+        failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print(f"\nОШИБКА: медиана {median:.0f} мс больше порога {args.max_ms:.0f} мс")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
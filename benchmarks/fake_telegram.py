@@ -0,0 +1,156 @@
+"""Локальный фейковый Bot API для нагрузочных тестов.
+
+Отвечает на методы, которые вызывает бот, считает все вызовы и с заданной
+вероятностью добавляет задержку, 429 (Too Many Requests) и 403 «bot was
+blocked by the user». Заблокировавший бота пользователь остаётся таким до
+сброса статистики, как в настоящем Telegram.
+
+    python benchmarks/fake_telegram.py --port 8081 --latency 0.02 --retry-rate 0.01 --blocked-rate 0.05
+
+Отправленные файлы получают file_id, и повторная отправка по нему не считается
+загрузкой (вызовы sendphoto:upload и т. п. в статистике). Сервер также считает
+TCP-соединения, открытые клиентом. Статистика вызовов отдаётся на GET /stats,
+сброс - POST /reset.
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# Методы, которые отправляют сообщение пользователю и могут получить 403
+SEND_METHODS = {"sendmessage", "sendphoto", "senddocument", "sendvideo", "copymessage"}
+# Методы, которые возвращают отправленное или изменённое сообщение
+MESSAGE_METHODS = SEND_METHODS | {"editmessagetext", "editmessagecaption", "editmessagereplymarkup"}
+# Методы отправки файлов: параметр с файлом и поле сообщения с ним
+MEDIA_METHODS = {"sendphoto": "photo", "senddocument": "document", "sendvideo": "video"}
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0, retry_rate: float = 0, retry_after: int = 1, blocked_rate: float = 0):
+        self.latency = latency
+        self.retry_rate = retry_rate
+        self.retry_after = retry_after
+        self.blocked_rate = blocked_rate
+        self.reset()
+
+    def reset(self):
+        self.calls = Counter()
+        self.errors = Counter()
+        self.blocked = set()
+        self.file_ids = set()
+        # Адреса клиентских сокетов: у каждого TCP-соединения свой порт
+        self.connections = set()
+        self._message_id = 0
+
+    def _message(self, chat_id) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}
+        }
+
+    def _media(self, method: str, message: dict, params: dict):
+        """Добавляет в сообщение файл; уже известный file_id возвращается как есть."""
+        field = MEDIA_METHODS[method]
+        file_id = params.get(field)
+        if not isinstance(file_id, str) or file_id not in self.file_ids:
+            file_id = f"{field}-{message['message_id']}"
+            self.file_ids.add(file_id)
+            self.calls[f"{method}:upload"] += 1
+        media = {"file_id": file_id, "file_unique_id": file_id}
+        if field == "photo":
+            message["photo"] = [dict(media, width=1280, height=720)]
+        else:
+            message[field] = dict(media, width=1280, height=720, duration=1) if field == "video" else media
+        return message
+
+    def _result(self, method: str, params: dict):
+        if method == "getme":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method in MEDIA_METHODS:
+            return self._media(method, self._message(_chat_id(params)), params)
+        if method in MESSAGE_METHODS:
+            return self._message(_chat_id(params))
+        if method == "getchatmember":
+            user_id = int(params.get("user_id", 0))
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+        if method == "getupdates":
+            return []
+        return True
+
+    def _error(self, code: int, description: str, **parameters) -> web.Response:
+        self.errors[code] += 1
+        payload = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            payload["parameters"] = parameters
+        return web.json_response(payload, status=code)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        self.calls[method] += 1
+        self.connections.add(request.transport.get_extra_info("peername"))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.retry_rate and random.random() < self.retry_rate:
+            return self._error(
+                429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after
+            )
+        if method in SEND_METHODS:
+            chat_id = _chat_id(params)
+            if chat_id not in self.blocked and self.blocked_rate and random.random() < self.blocked_rate:
+                self.blocked.add(chat_id)
+            if chat_id in self.blocked:
+                return self._error(403, "Forbidden: bot was blocked by the user")
+        if method in MEDIA_METHODS:
+            media = params.get(MEDIA_METHODS[method])
+            # Строка без схемы - file_id; чужие file_id Telegram не принимает
+            if isinstance(media, str) and "://" not in media and media not in self.file_ids:
+                return self._error(400, "Bad Request: wrong file identifier/HTTP URL specified")
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "calls": dict(self.calls),
+            "errors": {str(code): n for code, n in self.errors.items()},
+            "blocked_users": len(self.blocked),
+            "connections": len(self.connections)
+        })
+
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({"ok": True})
+
+def _chat_id(params: dict):
+    chat_id = params.get("chat_id", 0)
+    try:
+        return int(chat_id)
+    except ValueError:
+        return chat_id
+
+def create_app(fake: FakeTelegram) -> web.Application:
+    # Bot API принимает файлы до 50 МБ
+    app = web.Application(client_max_size=50 * 1024 * 1024)
+    app.router.add_post("/bot{token}/{method}", fake.handle)
+    app.router.add_get("/stats", fake.stats)
+    app.router.add_post("/reset", fake.handle_reset)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument("--retry-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked-rate", type=float, default=0.0, help="доля пользователей, заблокировавших бота")
+    args = parser.parse_args()
+    fake = FakeTelegram(args.latency, args.retry_rate, args.retry_after, args.blocked_rate)
+    web.run_app(create_app(fake), host=args.host, port=args.port, print=None)
+
+if __name__ == "__main__":
+    main()
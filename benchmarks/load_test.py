@@ -0,0 +1,220 @@
+"""Нагрузочный тест бота на фейковом Bot API.
+
+Настоящий диспетчер бота обрабатывает синтетический поток обновлений, а все
+запросы к Telegram уходят на benchmarks/fake_telegram.py, запущенный отдельным
+процессом. Выводит обновления в секунду, p50/p99 времени обработки обновления
+и запросов к API, пиковый RSS процесса бота.
+
+    python benchmarks/load_test.py start --updates 5000 --concurrency 100
+    python benchmarks/load_test.py click --updates 20000
+    python benchmarks/load_test.py text --updates 20000 --latency 0.02
+    python benchmarks/load_test.py mixed --updates 20000 --retry-rate 0.01
+    python benchmarks/load_test.py broadcast --users 50000 --rate 1000 --blocked-rate 0.05
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SERVER = os.path.join(ROOT, "benchmarks", "fake_telegram.py")
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_API_TOKEN", "123456:BENCHMARK-TOKEN")
+# bot.py создаёт каталог data и bot.log в текущей директории
+os.chdir(tempfile.mkdtemp(prefix="load_test_"))
+
+import aiohttp  # noqa: E402
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+import bot as bot_module  # noqa: E402
+
+BUTTONS = [bot_module.ButtonCallback(name=key).pack() for key, _ in bot_module.START_BUTTONS]
+# Доли обновлений в сценарии mixed
+MIXED_WEIGHTS = {"start": 0.2, "click": 0.5, "text": 0.3}
+
+class ApiLatencyRecorder(BaseRequestMiddleware):
+    """Запоминает время каждого запроса к API по методам."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            self.latencies[method.__api_method__].append(time.perf_counter() - started)
+
+def make_update(update_id: int, user_id: int, kind: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    now = int(time.time())
+    if kind == "click":
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": random.choice(BUTTONS),
+            "message": {"message_id": 1, "date": now, "chat": chat}
+        }}
+    text = "/start" if kind == "start" else "Привет! Что ты умеешь?"
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": now, "chat": chat, "from": user, "text": text
+    }}
+
+def generate_updates(args):
+    kinds = list(MIXED_WEIGHTS) if args.scenario == "mixed" else [args.scenario]
+    weights = [MIXED_WEIGHTS[kind] for kind in kinds] if args.scenario == "mixed" else None
+    for update_id in range(1, args.updates + 1):
+        kind = random.choices(kinds, weights)[0]
+        yield make_update(update_id, random.randint(1, args.users), kind)
+
+def percentiles(values: list) -> tuple:
+    """p50 и p99 в миллисекундах."""
+    if len(values) < 2:
+        value = values[0] * 1000 if values else 0.0
+        return value, value
+    q = statistics.quantiles(values, n=100)
+    return q[49] * 1000, q[98] * 1000
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def start_fake_server(args):
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, FAKE_SERVER,
+        "--port", str(port),
+        "--latency", str(args.latency),
+        "--retry-rate", str(args.retry_rate),
+        "--retry-after", str(args.retry_after),
+        "--blocked-rate", str(args.blocked_rate)
+    ])
+    url = f"http://127.0.0.1:{port}"
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(f"{url}/stats"):
+                    return process, url
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Фейковый Bot API не запустился")
+
+async def fetch_stats(url: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{url}/stats") as response:
+            return await response.json()
+
+async def run_updates(args) -> int:
+    """Прогоняет поток обновлений через диспетчер, возвращает число обработанных."""
+    updates = generate_updates(args)
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for raw in updates:
+            started = time.perf_counter()
+            try:
+                await bot_module.dp.feed_raw_update(bot_module.bot, raw)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    p50, p99 = percentiles(latencies)
+    print(f"обновлений:       {len(latencies)} ({args.scenario}, {args.users} пользователей)")
+    print(f"ошибок:           {errors}")
+    print(f"время:            {elapsed:.2f} сек")
+    print(f"скорость:         {len(latencies) / elapsed:.1f} обновлений/сек")
+    print(f"обработка:        p50 {p50:.1f} мс, p99 {p99:.1f} мс")
+    return len(latencies)
+
+async def run_broadcast(args):
+    """Рассылка по args.users пользователям с контрольными точками в базе."""
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    await bot_module.db.executemany(
+        '''INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, joined_date, last_activity)
+           VALUES (?, ?, ?, ?, ?, ?)''',
+        [(user_id, f"user{user_id}", f"User{user_id}", "", now, now) for user_id in range(1, args.users + 1)]
+    )
+    status_message = bot_module.job_status_message(bot_module.ADMIN_ID or 1, 1)
+    job_id = await bot_module.create_broadcast_job("Нагрузочный тест", "HTML", status_message)
+    chat_ids = bot_module.iter_pending_recipients(job_id)
+
+    checkpoint = bot_module.BroadcastCheckpoint(job_id)
+    engine = bot_module.BroadcastEngine(bot_module.bot, rate=args.rate, concurrency=args.concurrency)
+    result = await engine.run(chat_ids, "Нагрузочный тест", parse_mode="HTML", on_result=checkpoint.add)
+    await checkpoint.flush()
+    progress = await bot_module.get_broadcast_progress(job_id)
+
+    print(f"получателей:      {result.processed}")
+    print(f"результат:        sent={result.sent}, blocked={result.blocked}, failed={result.failed}")
+    print(f"в базе:           {progress}")
+    print(f"повторов:         {result.retries}")
+    print(f"время:            {result.elapsed:.2f} сек")
+    print(f"скорость:         {result.rate:.1f} сообщ./сек (лимит {args.rate})")
+
+async def run(args):
+    process, url = await start_fake_server(args)
+    recorder = ApiLatencyRecorder()
+    bot_module.bot.session.api = TelegramAPIServer.from_base(url)
+    bot_module.bot.session.middleware(recorder)
+
+    # Лог пишется в bot.log, как в работе; в консоль выводится только отчёт
+    listener = bot_module.log_listener
+    listener.handlers = tuple(h for h in listener.handlers if type(h) is not logging.StreamHandler)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        await bot_module.init_db()
+        await bot_module.start_services("single")
+        if args.scenario == "broadcast":
+            await run_broadcast(args)
+        else:
+            await run_updates(args)
+        stats = await fetch_stats(url)
+    finally:
+        await bot_module.stop_services()
+        process.terminate()
+        process.wait()
+
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"пиковый RSS:      {rss_peak / 1024:.1f} МБ (до теста {rss_before / 1024:.1f} МБ)")
+    print(f"вызовы API:       {stats['calls']}")
+    print(f"ошибки API:       {stats['errors']}, заблокировали бота: {stats['blocked_users']}")
+    for method, values in sorted(recorder.latencies.items()):
+        p50, p99 = percentiles(values)
+        print(f"  {method:<20} {len(values):>7}  p50 {p50:7.1f} мс  p99 {p99:7.1f} мс")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenario", choices=["start", "click", "text", "mixed", "broadcast"])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1000, help="лимит рассылки, сообщений в секунду")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--retry-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked-rate", type=float, default=0.0)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Отправляет записанные Update из JSON Lines на webhook бота.
+
+Позволяет проверить режим webhook локально, без Telegram: каждая строка
+файла - один объект Update, как его присылает Bot API.
+
+    BOT_MODE=webhook WEBHOOK_URL=https://example.com WEBHOOK_SECRET=s3cret python bot.py
+    python benchmarks/post_updates.py --url http://127.0.0.1:8080/webhook --secret s3cret --repeat 100
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from collections import Counter
+
+import aiohttp
+
+DEFAULT_UPDATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "updates.jsonl")
+
+def load_updates(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+async def run(args):
+    updates = load_updates(args.file)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    queue = asyncio.Queue()
+    update_id = 0
+    for _ in range(args.repeat):
+        for update in updates:
+            update_id += 1
+            queue.put_nowait(dict(update, update_id=update_id))
+
+    statuses = Counter()
+    latencies = []
+
+    async def worker(session):
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.perf_counter()
+            async with session.post(args.url, json=update, headers=headers) as response:
+                await response.read()
+                statuses[response.status] += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"отправлено:  {len(latencies)} за {elapsed:.2f} сек ({len(latencies) / elapsed:.0f} update/сек)")
+    print(f"ответы:      {dict(statuses)}")
+    print(f"задержка:    p50 {statistics.median(latencies):.1f} мс, "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.1f} мс")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    parser.add_argument("--file", default=DEFAULT_UPDATES)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=10)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,55 @@
 import asyncio
+import atexit
+import glob
+import gzip
+import hashlib
+import heapq
+import html
+import importlib
 import logging
 import json
+import math
+import metrics
+import multiprocessing
 import os
+import secrets
+import shutil
 import aiofiles
 import sqlite3
-import pandas as pd
-from datetime import datetime
+import time
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Empty, SimpleQueue
 from dotenv import load_dotenv
 import signal
 from signal import SIGINT, SIGTERM
 
-from aiogram import Bot, Dispatcher
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import (
+    Chat,
     Message,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     CallbackQuery,
+    ChatMemberUpdated,
     FSInputFile
 )
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError
+from aiogram.filters import Command, StateFilter
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # ==== 🔹 Настройки бота ====
 load_dotenv()
@@ -29,286 +58,1748 @@ API_TOKEN = os.getenv("BOT_API_TOKEN")
 if not API_TOKEN:
     raise ValueError("Не найден токен бота. Проверьте файл .env")
 
-CHANNEL_USERNAME_OR_ID = "-1002490792993"
+# Подписка на этот канал открывает ссылки приветствия и промокод; пустое значение отключает проверку
+CHANNEL_USERNAME_OR_ID = os.getenv("CHANNEL_USERNAME_OR_ID", "-1002490792993")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
 GPT_BOT_USERNAME = "roxsonai_bot"
 PROMO_CODE = "SECRET15"
 PROMO_DELAY = 10
+PROMO_CAMPAIGN = "promo"
+WELCOME_PHOTO_URL = "https://i.postimg.cc/KYThRhy6/image.png"
 MY_USERNAME = "dmitrenko_ai"
 
 # Пути к файлам данных
 DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)  # Создаем директорию сразу
 
+EVENTS_FILE = os.path.join(DATA_DIR, "events.jsonl")
+DB_FILE = os.path.join(DATA_DIR, "users.db")
+
+# Файлы прежних версий, их данные переносятся в базу при запуске
 LOGS_FILE = os.path.join(DATA_DIR, "logs.json")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
 STATS_FILE = os.path.join(DATA_DIR, "stats.json")
-DB_FILE = os.path.join(DATA_DIR, "users.db")
+
+# Адрес Bot API: по умолчанию api.telegram.org, BOT_API_URL - свой сервер telegram-bot-api.
+# BOT_API_LOCAL=1, если сервер запущен с --local (файлы до 2 ГБ, file_path - путь на диске)
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "0") == "1"
+
+# Тайм-аут запроса к Bot API; долгие методы перечислены в HTTP_METHOD_TIMEOUTS
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "15"))
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Метрики Prometheus отдаются на METRICS_HOST:METRICS_PORT/metrics, 0 (по умолчанию) - отключены
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Масштабирование: при BOT_WORKERS > 1 обновления распределяются по user_id
+# между процессами-обработчиками, а рассылки и отчёты выполняет отдельный процесс
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+JOBS_IN_SEPARATE_PROCESS = BOT_WORKERS > 1
+WORKER_CONCURRENCY = 100
+JOBS_POLL_INTERVAL = 2
+POLLING_TIMEOUT = 30
+HTTP_METHOD_TIMEOUTS = {
+    "getUpdates": POLLING_TIMEOUT + HTTP_TIMEOUT,
+    "sendPhoto": 120,
+    "sendVideo": 120,
+    "sendDocument": 120,
+}
+
+# Хранилище состояний FSM: memory или sqlite (общее для всех процессов)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite" if BOT_WORKERS > 1 else "memory")
+
+# Настройки рассылки. Telegram допускает ~30 сообщений в секунду суммарно
+# и не больше одного сообщения в секунду в один чат
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+# Соединений с Bot API: по одному на обработчик обновлений и отправителя рассылки,
+# чтобы запросы не ждали свободного соединения (у aiogram по умолчанию 100)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(WORKER_CONCURRENCY + BROADCAST_CONCURRENCY)))
+BROADCAST_PER_CHAT_INTERVAL = 1.0
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_CHECKPOINT_SIZE = 200
+# Получатели рассылки читаются из базы порциями
+BROADCAST_FETCH_SIZE = 1000
+# Сообщение с прогрессом рассылки или отчёта правится не чаще раза в PROGRESS_INTERVAL сек.
+PROGRESS_INTERVAL = 5
+
+# Кэш проверки «новый ли пользователь»
+USER_BLOOM_CAPACITY = 1_000_000
+USER_CACHE_SIZE = 100_000
+
+# Защита от флуда: событий в секунду и подряд от одного пользователя на обработчик.
+# Обработчик может задать свои лимиты флагом throttle=(rate, burst). THROTTLE_RATE=0 отключает защиту
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", "5"))
+if THROTTLE_RATE < 0 or THROTTLE_BURST < 1:
+    raise ValueError("THROTTLE_RATE не может быть отрицательным, THROTTLE_BURST должен быть не меньше 1")
+THROTTLE_MAX_USERS = 100_000
+
+# Кэш проверки подписки (getChatMember): подписчики - на SUBSCRIPTION_TTL сек.,
+# остальные - на SUBSCRIPTION_NEGATIVE_TTL, чтобы новая подписка не ждала долго
+SUBSCRIPTION_TTL = 600
+SUBSCRIPTION_NEGATIVE_TTL = 60
+SUBSCRIPTION_CACHE_SIZE = 100_000
+
+# Журнал событий: сегмент закрывается по размеру или раз в сутки
+EVENTS_ROTATE_BYTES = 10 * 1024 * 1024
+EVENTS_ROTATE_AGE = 24 * 60 * 60
+EVENTS_FLUSH_INTERVAL = 1
+
+# Отложенные сообщения отправляются пачками не быстрее SCHEDULER_RATE в секунду
+SCHEDULER_RATE = 10
+SCHEDULER_BATCH_SIZE = 50
+# Через сколько секунд повторить неудачное сохранение статусов отправленных сообщений
+SCHEDULER_RETRY_INTERVAL = 5
+
+# Счётчики нажатий кнопок сохраняются в базу раз в STATS_FLUSH_INTERVAL секунд
+STATS_FLUSH_INTERVAL = 30
+
+# Отметки активности пользователей пишутся в базу пачками
+ACTIVITY_FLUSH_INTERVAL = 5
+ACTIVITY_FLUSH_SIZE = 1000
+
+# Лог: JSON-строки в bot.log с ротацией по размеру. Частые INFO-записи
+# (нажатия кнопок, новые пользователи) пропускаются не чаще LOG_SAMPLE_RATE в секунду
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_SAMPLE_RATE = 20
 
 # ==== Логирование ====
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(DATA_DIR, 'bot.log')),
-        logging.StreamHandler()
-    ]
-)
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON, с полями из extra."""
+
+    FIELDS = ("user_id", "handler", "latency_ms", "update_type", "suppressed")
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "process": record.processName,
+            "message": record.getMessage()
+        }
+        for name in self.FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """Не больше rate INFO-записей в секунду с одним ключом extra={"sample": ключ}."""
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        self._windows = {}
+
+    def filter(self, record):
+        key = getattr(record, "sample", None)
+        if key is None or record.levelno > logging.INFO:
+            return True
+        second = int(time.monotonic())
+        window, passed, suppressed = self._windows.get(key, (second, 0, 0))
+        if window != second:
+            window, passed = second, 0
+        if passed >= self.rate:
+            self._windows[key] = (window, passed, suppressed + 1)
+            return False
+        # Число отброшенных записей попадает в следующую пропущенную
+        if suppressed:
+            record.suppressed = suppressed
+        self._windows[key] = (window, passed + 1, 0)
+        return True
+
+def setup_logging() -> QueueListener:
+    """Обработчики пишут записи в очередь, файл и консоль обслуживает отдельный поток."""
+    process_name = multiprocessing.current_process().name
+    # RotatingFileHandler не рассчитан на несколько процессов, у каждого свой файл
+    log_name = "bot.log" if process_name == "MainProcess" else f"{process_name}.log"
+
+    file_handler = RotatingFileHandler(
+        os.path.join(DATA_DIR, log_name),
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding="utf-8"
+    )
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+
+    # Строку «Update id=... is handled» на каждое обновление заменяет выборочная запись
+    # HandlerMetricsMiddleware с теми же данными
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    # Остановка дописывает записи, оставшиеся в очереди
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+
+# ==== Хранилище состояний FSM ====
+class SQLiteStorage(BaseStorage):
+    """Состояния FSM в таблице fsm_states, общие для всех процессов бота."""
+
+    def __init__(self, key_builder: KeyBuilder = None):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        state = state.state if isinstance(state, State) else state
+        await db.execute('''INSERT INTO fsm_states (key, state) VALUES (?, ?)
+                            ON CONFLICT (key) DO UPDATE SET state = excluded.state''',
+                         (self.key_builder.build(key), state))
+
+    async def get_state(self, key: StorageKey):
+        row = await db.fetchone('SELECT state FROM fsm_states WHERE key = ?', (self.key_builder.build(key),))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: dict):
+        await db.execute('''INSERT INTO fsm_states (key, data) VALUES (?, ?)
+                            ON CONFLICT (key) DO UPDATE SET data = excluded.data''',
+                         (self.key_builder.build(key), json.dumps(data, ensure_ascii=False)))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        row = await db.fetchone('SELECT data FROM fsm_states WHERE key = ?', (self.key_builder.build(key),))
+        return json.loads(row[0]) if row and row[0] else {}
+
+    async def close(self):
+        pass
+
+def create_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "sqlite":
+        return SQLiteStorage()
+    return MemoryStorage()
+
+# ==== HTTP-сессия Bot API ====
+class BotApiSession(AiohttpSession):
+    """AiohttpSession с тайм-аутами по методам: загрузка файлов и long polling дольше обычного запроса."""
+
+    def __init__(self, method_timeouts: dict, **kwargs):
+        super().__init__(**kwargs)
+        self.method_timeouts = method_timeouts
+
+    async def make_request(self, bot: Bot, method, timeout: int = None):
+        if timeout is None:
+            timeout = self.method_timeouts.get(method.__api_method__)
+        return await super().make_request(bot, method, timeout)
+
+def create_bot_session(api_url: str = BOT_API_URL, pool_size: int = HTTP_POOL_SIZE) -> BotApiSession:
+    kwargs = {"timeout": HTTP_TIMEOUT}
+    if api_url:
+        kwargs["api"] = TelegramAPIServer.from_base(api_url, is_local=BOT_API_LOCAL)
+    return BotApiSession(HTTP_METHOD_TIMEOUTS, limit=pool_size, **kwargs)
 
 # ==== Создаём бот и диспетчер ====
 try:
-    bot = Bot(token=API_TOKEN)
-    dp = Dispatcher()
+    bot = Bot(token=API_TOKEN, session=create_bot_session())
+    dp = Dispatcher(storage=create_fsm_storage())
 except Exception as e:
     logging.error(f"Ошибка при инициализации бота: {e}")
     raise
 
+# ==== Защита от флуда ====
+class ThrottlingMiddleware(BaseMiddleware):
+    """Token bucket на пару (пользователь, обработчик); лимит задаёт флаг throttle=(rate, burst)."""
+
+    def __init__(self, rate: float, burst: int, max_size: int):
+        self.default = (rate, burst)
+        self.max_size = max_size
+        # (токены, время, когда ведро наполнится, предупреждён) по времени последнего события
+        self._buckets = OrderedDict()
+
+    def _evict(self, now: float):
+        # Полное ведро не отличается от отсутствующего, его можно удалить
+        while self._buckets:
+            key, state = next(iter(self._buckets.items()))
+            if state[2] > now and len(self._buckets) <= self.max_size:
+                return
+            del self._buckets[key]
+
+    def allow(self, key, rate: float, burst: int) -> tuple:
+        """Возвращает (пропустить ли событие, нужно ли предупредить пользователя)."""
+        now = time.monotonic()
+        tokens, updated, _, warned = self._buckets.pop(key, (burst, now, now, False))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            tokens -= 1
+            allowed, notify, warned = True, False, False
+        else:
+            allowed, notify, warned = False, not warned, True
+        self._buckets[key] = (tokens, now, now + (burst - tokens) / rate, warned)
+        self._evict(now)
+        return allowed, notify
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        limit = get_flag(data, "throttle", default=self.default)
+        if user is None or user.id == ADMIN_ID or limit is None:
+            return await handler(event, data)
+
+        name = data["handler"].callback.__name__
+        allowed, notify = self.allow((user.id, name), *limit)
+        if allowed:
+            return await handler(event, data)
+
+        metrics.THROTTLED.labels(name).inc()
+        logging.info(f"Пользователь {user.id} превысил лимит {name}",
+                     extra={"user_id": user.id, "handler": name, "sample": "throttled"})
+        # Подсказка только на первое лишнее нажатие, дальше события отбрасываются молча
+        if notify and isinstance(event, CallbackQuery):
+            await event.answer(get_text("throttled", user_language(user)))
+
+throttling = ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_USERS)
+if THROTTLE_RATE:
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
+
+# ==== Метрики ====
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Считает входящие обновления по типу."""
+
+    async def __call__(self, handler, event, data):
+        metrics.UPDATES.labels(event.event_type).inc()
+        return await handler(event, data)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы и ошибки каждого обработчика, по имени его функции."""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            latency = time.perf_counter() - started
+            metrics.HANDLER_LATENCY.labels(name).observe(latency)
+            user = data.get("event_from_user")
+            logging.info(f"{name} выполнен за {latency * 1000:.1f} мс", extra={
+                "user_id": user.id if user else None,
+                "handler": name,
+                "update_type": data["event_update"].event_type,
+                "latency_ms": round(latency * 1000, 1),
+                "sample": "handler"
+            })
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки запросов к Bot API по методам."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            metrics.API_RETRY_AFTER.labels(name).inc()
+            raise
+        except Exception as e:
+            metrics.API_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            metrics.API_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+class ErrorCountHandler(logging.Handler):
+    def emit(self, record):
+        metrics.LOGGED_ERRORS.inc()
+
+logging.getLogger().addHandler(ErrorCountHandler(logging.ERROR))
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())
+
 # ==== FSM: состояние для рассылки ====
 class BroadcastStates(StatesGroup):
     waiting_broadcast_text = State()
     confirm_broadcast = State()
 
 # ==== Функции для работы с базой данных ====
-def init_db():
+class Database:
+    """Одно соединение SQLite в режиме WAL, запросы по очереди в отдельном потоке."""
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=134217728",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            for pragma in self.PRAGMAS:
+                self._conn.execute(pragma)
+        return self._conn
+
+    async def run(self, func, *args):
+        """Выполняет func(conn, *args) в потоке базы данных."""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, lambda: func(self._connect(), *args))
+        finally:
+            metrics.DB_LATENCY.labels(func.__name__.lstrip("_")).observe(time.perf_counter() - started)
+
+    async def execute(self, sql: str, params=()) -> int:
+        """Выполняет запрос с коммитом и возвращает число изменённых строк."""
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self.run(_execute)
+
+    async def executemany(self, sql: str, seq_of_params) -> int:
+        def _executemany(conn):
+            with conn:
+                return conn.executemany(sql, seq_of_params).rowcount
+        return await self.run(_executemany)
+
+    async def fetchall(self, sql: str, params=()) -> list:
+        def _fetchall(conn):
+            return conn.execute(sql, params).fetchall()
+        return await self.run(_fetchall)
+
+    async def fetchone(self, sql: str, params=()):
+        def _fetchone(conn):
+            return conn.execute(sql, params).fetchone()
+        return await self.run(_fetchone)
+
+    async def close(self):
+        def _close(conn):
+            conn.close()
+            self._conn = None
+        if self._conn is not None:
+            await self.run(_close)
+        self._executor.shutdown(wait=True)
+
+db = Database(DB_FILE)
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, declaration: str):
+    """Добавляет колонку в таблицу, созданную прежней версией бота."""
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+def _create_schema(conn: sqlite3.Connection):
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS users
+                        (user_id INTEGER PRIMARY KEY,
+                         username TEXT,
+                         first_name TEXT,
+                         last_name TEXT,
+                         joined_date TEXT,
+                         last_activity TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs
+                        (job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         text TEXT NOT NULL,
+                         parse_mode TEXT,
+                         status TEXT NOT NULL DEFAULT 'running',
+                         created_at TEXT,
+                         finished_at TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_recipients
+                        (job_id INTEGER NOT NULL,
+                         user_id INTEGER NOT NULL,
+                         status TEXT NOT NULL DEFAULT 'pending',
+                         PRIMARY KEY (job_id, user_id)) WITHOUT ROWID''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status
+                        ON broadcast_recipients (job_id, status)''')
+        _add_column(conn, 'users', 'blocked', 'INTEGER NOT NULL DEFAULT 0')
+        _add_column(conn, 'users', 'blocked_at', 'TEXT')
+        _add_column(conn, 'users', 'fail_count', 'INTEGER NOT NULL DEFAULT 0')
+        _add_column(conn, 'users', 'last_error', 'TEXT')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users (last_activity)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_users_joined_date ON users (joined_date)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS user_buttons
+                        (button TEXT NOT NULL,
+                         user_id INTEGER NOT NULL,
+                         PRIMARY KEY (button, user_id)) WITHOUT ROWID''')
+        _add_column(conn, 'broadcast_jobs', 'status_chat_id', 'INTEGER')
+        _add_column(conn, 'broadcast_jobs', 'status_message_id', 'INTEGER')
+        conn.execute('''CREATE TABLE IF NOT EXISTS report_jobs
+                        (job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         report_format TEXT NOT NULL,
+                         chat_id INTEGER NOT NULL,
+                         message_id INTEGER NOT NULL,
+                         status TEXT NOT NULL DEFAULT 'pending',
+                         created_at TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS fsm_states
+                        (key TEXT PRIMARY KEY,
+                         state TEXT,
+                         data TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS scheduled_messages
+                        (user_id INTEGER NOT NULL,
+                         campaign TEXT NOT NULL,
+                         due_at REAL NOT NULL,
+                         status TEXT NOT NULL DEFAULT 'pending',
+                         PRIMARY KEY (user_id, campaign)) WITHOUT ROWID''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_scheduled_messages_status
+                        ON scheduled_messages (status, due_at)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS media_cache
+                        (key TEXT PRIMARY KEY,
+                         file_id TEXT NOT NULL,
+                         updated_at TEXT) WITHOUT ROWID''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS button_clicks
+                        (button TEXT NOT NULL,
+                         day TEXT NOT NULL,
+                         clicks INTEGER NOT NULL DEFAULT 0,
+                         PRIMARY KEY (button, day)) WITHOUT ROWID''')
+        _add_column(conn, 'users', 'first_click', 'TEXT')
+        _add_column(conn, 'users', 'language', 'TEXT')
+        rollups_exist = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_stats'"
+        ).fetchone()
+        conn.execute('''CREATE TABLE IF NOT EXISTS daily_stats
+                        (day TEXT NOT NULL,
+                         metric TEXT NOT NULL,
+                         value INTEGER NOT NULL DEFAULT 0,
+                         PRIMARY KEY (day, metric)) WITHOUT ROWID''')
+        if not rollups_exist:
+            _backfill_daily_stats(conn)
+
+async def init_db():
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                     (user_id INTEGER PRIMARY KEY,
-                      username TEXT,
-                      first_name TEXT,
-                      last_name TEXT,
-                      joined_date TEXT,
-                      last_activity TEXT)''')
-        conn.commit()
-        conn.close()
+        await db.run(_create_schema)
         logging.info("База данных успешно инициализирована")
     except Exception as e:
         logging.error(f"Ошибка при инициализации базы данных: {e}")
         raise
 
-async def add_user(user_id: int, username: str, first_name: str, last_name: str):
-    conn = None
+# ==== Сводная статистика по дням ====
+# Счётчики в daily_stats обновляются в тех же транзакциях, что и сами события,
+# поэтому сводка читает несколько строк на день вместо обхода users:
+#   new_users    - новые пользователи (первый /start);
+#   active_users - DAU: пользователи, впервые за этот день обновившие last_activity;
+#   promo_sent   - доставленные промокоды (по одному на пользователя);
+#   clickers     - пользователи, впервые нажавшие кнопку.
+# Нажатия по кнопкам и дням хранит button_clicks.
+STATS_UPSERT = '''INSERT INTO daily_stats (day, metric, value) VALUES (?, ?, ?)
+                  ON CONFLICT (day, metric) DO UPDATE SET value = value + excluded.value'''
+
+def _bump_daily_stats(conn: sqlite3.Connection, day: str, counts: dict):
+    """Прибавляет counts {metric: n} к счётчикам дня; вызывается внутри транзакции."""
+    conn.executemany(STATS_UPSERT, [(day, metric, int(n)) for metric, n in counts.items() if n])
+
+def _backfill_daily_stats(conn: sqlite3.Connection):
+    """Заполняет сводку по данным, накопленным до её появления."""
+    conn.execute('''INSERT INTO daily_stats (day, metric, value)
+                    SELECT substr(joined_date, 1, 10), 'new_users', COUNT(*) FROM users
+                    WHERE joined_date IS NOT NULL GROUP BY 1''')
+    # DAU прошлых дней не восстановить: пользователь учитывается только в день последней активности
+    conn.execute('''INSERT INTO daily_stats (day, metric, value)
+                    SELECT substr(last_activity, 1, 10), 'active_users', COUNT(*) FROM users
+                    WHERE last_activity IS NOT NULL GROUP BY 1''')
+    conn.execute('''INSERT INTO daily_stats (day, metric, value)
+                    SELECT date(due_at, 'unixepoch', 'localtime'), campaign || '_sent', COUNT(*)
+                    FROM scheduled_messages WHERE status = 'sent' GROUP BY 1, 2''')
+    # Дата первого нажатия не хранилась, для прежних нажавших берётся дата регистрации
+    conn.execute('''UPDATE users SET first_click = joined_date
+                    WHERE user_id IN (SELECT user_id FROM user_buttons)''')
+    conn.execute('''INSERT INTO daily_stats (day, metric, value)
+                    SELECT substr(first_click, 1, 10), 'clickers', COUNT(*) FROM users
+                    WHERE first_click IS NOT NULL GROUP BY 1''')
+
+async def get_daily_stats(days: int) -> dict:
+    """Счётчики за последние days дней: {день: {метрика: значение}}."""
+    since = (date.today() - timedelta(days=days - 1)).isoformat()
+    stats = defaultdict(Counter)
+    rows = await db.fetchall('SELECT day, metric, value FROM daily_stats WHERE day >= ?', (since,))
+    for day, metric, value in rows:
+        stats[day][metric] = value
+    return stats
+
+async def get_stats_totals() -> Counter:
+    """Суммы счётчиков за всё время; в сводке всего несколько строк на день."""
+    rows = await db.fetchall('SELECT metric, SUM(value) FROM daily_stats GROUP BY metric')
+    return Counter(dict(rows))
+
+async def add_user(user_id: int, username: str, first_name: str, last_name: str, language: str) -> bool:
+    """Добавляет пользователя или обновляет его профиль; возвращает True для нового."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    today = now[:10]
+    definitely_new, seen_day = user_cache.lookup(user_id)
+
+    def _add_user(conn):
+        with conn:
+            # Кэш избавляет от SELECT новых и уже заходивших сегодня пользователей
+            if definitely_new:
+                row = None
+            elif seen_day == today:
+                row = (today,)
+            else:
+                row = conn.execute('SELECT last_activity FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            # Для существующего пользователя обновляем профиль, сохраняя дату регистрации.
+            # Новый /start означает, что бот снова доступен: снимаем отметку о блокировке
+            conn.execute('''INSERT INTO users
+                            (user_id, username, first_name, last_name, joined_date, last_activity, language)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (user_id) DO UPDATE SET
+                                username = excluded.username,
+                                first_name = excluded.first_name,
+                                last_name = excluded.last_name,
+                                last_activity = excluded.last_activity,
+                                language = excluded.language,
+                                blocked = 0,
+                                blocked_at = NULL,
+                                fail_count = 0''',
+                         (user_id, username, first_name, last_name, now, now, language))
+            _bump_daily_stats(conn, today, {
+                "new_users": row is None,
+                "active_users": row is None or (row[0] or "") < today
+            })
+            return row is None
+
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        c.execute('''INSERT OR REPLACE INTO users 
-                     (user_id, username, first_name, last_name, joined_date, last_activity)
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                  (user_id, username, first_name, last_name, now, now))
-        conn.commit()
-        logging.info(f"Пользователь {user_id} добавлен в базу данных")
+        is_new = await db.run(_add_user)
+        user_cache.remember(user_id, today)
+        logging.info(f"Пользователь {user_id} добавлен в базу данных",
+                     extra={"user_id": user_id, "sample": "add_user"})
+        return is_new
     except Exception as e:
         logging.error(f"Ошибка при добавлении пользователя {user_id}: {e}")
         raise
-    finally:
-        if conn:
-            conn.close()
+
+async def get_user_language(user_id: int) -> str:
+    """Язык, сохранённый при последнем /start, для сообщений не в ответ пользователю."""
+    row = await db.fetchone('SELECT language FROM users WHERE user_id = ?', (user_id,))
+    return row[0] if row and row[0] in TEXTS else DEFAULT_LANGUAGE
+
+class ActivityBuffer:
+    """Отметки last_activity копятся в памяти и сохраняются пачкой раз в interval секунд."""
+
+    # Более старая отметка не затирает более новую, записанную другим процессом
+    UPDATE = '''UPDATE users SET last_activity = ?
+                WHERE user_id = ? AND COALESCE(last_activity, '') < ?'''
+
+    def __init__(self, interval: float, max_size: int):
+        self.interval = interval
+        self.max_size = max_size
+        self._dirty = {}
+        self._full = None
+
+    def touch(self, user_id: int):
+        self._dirty[user_id] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if self._full is not None and len(self._dirty) >= self.max_size:
+            self._full.set()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+
+        def _save_activity(conn):
+            by_day = defaultdict(list)
+            for user_id, ts in batch.items():
+                by_day[ts[:10]].append((ts, user_id))
+            with conn:
+                for day, rows in by_day.items():
+                    # Сначала те, кто в этот день ещё не был активен: их число - прирост DAU
+                    c = conn.executemany(self.UPDATE, [(ts, user_id, day) for ts, user_id in rows])
+                    _bump_daily_stats(conn, day, {"active_users": c.rowcount})
+                    conn.executemany(self.UPDATE, [(ts, user_id, ts) for ts, user_id in rows])
+
+        try:
+            await db.run(_save_activity)
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении активности {len(batch)} пользователей: {e}")
+            # Возвращаем отметки в буфер, не затирая более свежие
+            for user_id, ts in batch.items():
+                self._dirty.setdefault(user_id, ts)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    def start(self):
+        self._full = asyncio.Event()
+        run_in_background(self.run())
+
+activity_buffer = ActivityBuffer(ACTIVITY_FLUSH_INTERVAL, ACTIVITY_FLUSH_SIZE)
 
 async def update_user_activity(user_id: int):
-    conn = None
+    activity_buffer.touch(user_id)
+
+# ==== Сегменты пользователей ====
+@dataclass(frozen=True)
+class Segment:
+    """Условия отбора получателей рассылки; пустой сегмент - все, кто не заблокировал бота."""
+    active_days: int = None
+    joined_from: date = None
+    joined_to: date = None
+    button: str = None
+    include_blocked: bool = False
+
+    def where(self) -> tuple:
+        """Условие WHERE по таблице users и его параметры."""
+        conditions, params = [], []
+        if not self.include_blocked:
+            conditions.append("blocked = 0")
+        if self.active_days is not None:
+            since = datetime.now() - timedelta(days=self.active_days)
+            conditions.append("last_activity >= ?")
+            params.append(since.strftime("%Y-%m-%d %H:%M:%S"))
+        if self.joined_from is not None:
+            conditions.append("joined_date >= ?")
+            params.append(self.joined_from.isoformat())
+        if self.joined_to is not None:
+            conditions.append("joined_date < ?")
+            params.append((self.joined_to + timedelta(days=1)).isoformat())
+        if self.button is not None:
+            conditions.append("user_id IN (SELECT user_id FROM user_buttons WHERE button = ?)")
+            params.append(self.button)
+        return " AND ".join(conditions) or "1", params
+
+async def count_segment(segment: Segment) -> int:
+    where, params = segment.where()
+    row = await db.fetchone(f'SELECT COUNT(*) FROM users WHERE {where}', params)
+    return row[0]
+
+# ==== Результаты доставки ====
+# Ошибки, после которых писать в чат бесполезно, пока пользователь снова не нажмёт /start
+DEAD_CHAT_ERRORS = {
+    "bot was blocked by the user": "blocked",
+    "user is deactivated": "deactivated",
+    "bot was kicked": "kicked",
+    "chat not found": "chat_not_found"
+}
+
+def classify_send_error(error: Exception) -> str:
+    """Тип ошибки отправки: один из DEAD_CHAT_ERRORS или error для прочих ошибок."""
+    description = str(error).lower()
+    for pattern, kind in DEAD_CHAT_ERRORS.items():
+        if pattern in description:
+            return kind
+    if isinstance(error, TelegramForbiddenError):
+        return "blocked"
+    return "error"
+
+def delivery_status(kind: str) -> str:
+    """Статус доставки по типу ошибки: blocked для мёртвых чатов, иначе failed."""
+    return "blocked" if kind in DEAD_CHAT_ERRORS.values() else "failed"
+
+def _save_delivery_results(conn: sqlite3.Connection, results: list):
+    """Записывает в users результаты доставки [(user_id, status, error), ...] внутри транзакции."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.executemany(
+        '''UPDATE users SET blocked = 1, blocked_at = COALESCE(blocked_at, ?),
+                            fail_count = fail_count + 1, last_error = ?
+           WHERE user_id = ?''',
+        [(now, error, user_id) for user_id, status, error in results if status == "blocked"]
+    )
+    conn.executemany(
+        'UPDATE users SET fail_count = fail_count + 1, last_error = ? WHERE user_id = ?',
+        [(error, user_id) for user_id, status, error in results if status == "failed"]
+    )
+    # Условие по fail_count не даёт переписывать строки тех, у кого ошибок не было
+    conn.executemany(
+        'UPDATE users SET fail_count = 0 WHERE user_id = ? AND fail_count > 0',
+        [(user_id,) for user_id, status, error in results if status == "sent"]
+    )
+
+async def record_delivery(user_id: int, status: str, error: str = None):
+    """Сохраняет результат одной доставки вне рассылки."""
+    def _record_delivery(conn):
+        with conn:
+            _save_delivery_results(conn, [(user_id, status, error)])
+
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        c.execute('UPDATE users SET last_activity = ? WHERE user_id = ?', (now, user_id))
-        conn.commit()
+        await db.run(_record_delivery)
     except Exception as e:
-        logging.error(f"Ошибка при обновлении активности пользователя {user_id}: {e}")
-        raise
-    finally:
-        if conn:
-            conn.close()
+        logging.error(f"Ошибка при сохранении результата доставки пользователю {user_id}: {e}")
 
-async def get_users_list():
-    conn = None
+async def reactivate_user(user_id: int):
+    """Снимает отметку о блокировке: пользователь снова доступен."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute('SELECT * FROM users ORDER BY joined_date DESC')
-        users = c.fetchall()
-        return users
+        await db.execute(
+            'UPDATE users SET blocked = 0, blocked_at = NULL, fail_count = 0 WHERE user_id = ? AND blocked = 1',
+            (user_id,)
+        )
     except Exception as e:
-        logging.error(f"Ошибка при получении списка пользователей: {e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
+        logging.error(f"Ошибка при разблокировке пользователя {user_id}: {e}")
 
-# ==== Функции для логов ====
-async def load_logs():
-    if not os.path.exists(LOGS_FILE):
-        return {}
-    try:
-        async with aiofiles.open(LOGS_FILE, "r", encoding="utf-8") as f:
-            content = await f.read()
-            return json.loads(content)
-    except FileNotFoundError:
-        return {}
-    except json.JSONDecodeError:
-        logging.error("Ошибка декодирования JSON в логах")
-        return {}
+async def filter_blocked(user_ids: list) -> set:
+    """Те из user_ids, кому доставка невозможна."""
+    if not user_ids:
+        return set()
+    placeholders = ", ".join("?" * len(user_ids))
+    rows = await db.fetchall(
+        f'SELECT user_id FROM users WHERE blocked = 1 AND user_id IN ({placeholders})', user_ids
+    )
+    return {user_id for (user_id,) in rows}
+
+# ==== Задания рассылки ====
+# Статусы задания: running, paused (прервано ошибкой, продолжается как running), done.
+# Статусы получателя: pending, sent, blocked, failed
+async def create_broadcast_job(text: str, parse_mode: str, status_message: Message, segment: Segment = None) -> int:
+    """Сохраняет задание рассылки и получателей из сегмента одной транзакцией."""
+    where, params = (segment or Segment()).where()
+
+    def _create_broadcast_job(conn):
+        with conn:
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            c = conn.execute('''INSERT INTO broadcast_jobs
+                                (text, parse_mode, created_at, status_chat_id, status_message_id)
+                                VALUES (?, ?, ?, ?, ?)''',
+                             (text, parse_mode, now, status_message.chat.id, status_message.message_id))
+            job_id = c.lastrowid
+            c = conn.execute(f'''INSERT INTO broadcast_recipients (job_id, user_id)
+                                 SELECT ?, user_id FROM users WHERE {where}''', (job_id, *params))
+            return job_id, c.rowcount
 
-async def save_log(user_id, action):
     try:
-        logs = await load_logs()
-        if str(user_id) not in logs:
-            logs[str(user_id)] = []
-        logs[str(user_id)].append({
-            "action": action,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
-
-        async with aiofiles.open(LOGS_FILE, "w", encoding="utf-8") as f:
-            await f.write(json.dumps(logs, ensure_ascii=False, indent=2))
+        job_id, recipients = await db.run(_create_broadcast_job)
+        logging.info(f"Создано задание рассылки #{job_id} на {recipients} получателей")
+        return job_id
     except Exception as e:
-        logging.error(f"Ошибка при сохранении лога для пользователя {user_id}: {e}")
+        logging.error(f"Ошибка при создании задания рассылки: {e}")
+        raise
 
-# ==== Функции для хранения списка user_id ====
-async def load_users() -> set:
-    if not os.path.exists(USERS_FILE):
-        return set()
+async def get_unfinished_broadcast_jobs():
     try:
-        async with aiofiles.open(USERS_FILE, "r", encoding="utf-8") as f:
-            content = await f.read()
-            data = json.loads(content)
-            return set(data)
+        return await db.fetchall('''SELECT job_id, text, parse_mode, status_chat_id, status_message_id
+                                    FROM broadcast_jobs WHERE status IN ('running', 'paused')
+                                    ORDER BY job_id''')
     except Exception as e:
-        logging.error(f"Ошибка при загрузке пользователей: {e}")
-        return set()
+        logging.error(f"Ошибка при получении незавершённых рассылок: {e}")
+        return []
+
+async def get_broadcast_progress(job_id: int) -> dict:
+    """Количество получателей задания по статусам."""
+    rows = await db.fetchall(
+        'SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status',
+        (job_id,)
+    )
+    return dict(rows)
+
+async def iter_pending_recipients(job_id: int, chunk_size: int = BROADCAST_FETCH_SIZE):
+    """Неотправленные получатели задания, порциями по первичному ключу."""
+    last_id = -1
+    while True:
+        rows = await db.fetchall(
+            '''SELECT user_id FROM broadcast_recipients
+               WHERE job_id = ? AND user_id > ? AND status = 'pending'
+               ORDER BY user_id LIMIT ?''',
+            (job_id, last_id, chunk_size)
+        )
+        if not rows:
+            return
+        for (user_id,) in rows:
+            yield user_id
+        last_id = rows[-1][0]
+
+async def save_recipient_statuses(job_id: int, statuses: list):
+    """Сохраняет пачку результатов [(user_id, status, error), ...] одним коммитом."""
+    def _save_recipient_statuses(conn):
+        with conn:
+            conn.executemany(
+                'UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?',
+                [(status, job_id, user_id) for user_id, status, error in statuses]
+            )
+            _save_delivery_results(conn, statuses)
 
-async def save_users(users: set):
     try:
-        async with aiofiles.open(USERS_FILE, "w", encoding="utf-8") as f:
-            await f.write(json.dumps(list(users), ensure_ascii=False, indent=2))
+        await db.run(_save_recipient_statuses)
     except Exception as e:
-        logging.error(f"Ошибка при сохранении списка пользователей: {e}")
+        logging.error(f"Ошибка при сохранении прогресса рассылки #{job_id}: {e}")
+        raise
+
+async def finish_broadcast_job(job_id: int, status: str = "done"):
+    """Закрывает задание: done - выполнено, paused - прервано ошибкой и будет продолжено."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    await db.execute("UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE job_id = ?",
+                     (status, now, job_id))
+
+# ==== Задания отчётов ====
+# Статусы задания: pending, running, done, failed
+async def create_report_job(report_format: str, status_message: Message) -> int:
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def _create_report_job(conn):
+        with conn:
+            return conn.execute('''INSERT INTO report_jobs (report_format, chat_id, message_id, created_at)
+                                   VALUES (?, ?, ?, ?)''',
+                                (report_format, status_message.chat.id, status_message.message_id, now)).lastrowid
+    return await db.run(_create_report_job)
+
+async def claim_report_jobs() -> list:
+    """Забирает ожидающие задания отчётов, помечая их как выполняемые."""
+    def _claim_report_jobs(conn):
+        with conn:
+            rows = conn.execute(
+                "SELECT job_id, report_format, chat_id, message_id FROM report_jobs WHERE status = 'pending'"
+            ).fetchall()
+            conn.executemany("UPDATE report_jobs SET status = 'running' WHERE job_id = ?",
+                             [(row[0],) for row in rows])
+            return rows
+    return await db.run(_claim_report_jobs)
+
+async def finish_report_job(job_id: int, status: str):
+    await db.execute('UPDATE report_jobs SET status = ? WHERE job_id = ?', (status, job_id))
+
+async def requeue_report_jobs() -> int:
+    """Возвращает в очередь отчёты, которые строились при остановке процесса заданий."""
+    return await db.execute("UPDATE report_jobs SET status = 'pending' WHERE status = 'running'")
+
+# ==== Журнал событий ====
+class EventLog:
+    """Журнал действий пользователей в JSON Lines, сегменты закрываются по размеру или возрасту."""
+
+    def __init__(self, path: str, max_bytes: int, max_age: float, flush_interval: float, max_buffer: int = 1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._base, self._ext = os.path.splitext(path)
+        self._buffer = []
+        self._segment_started = None
+        # При нескольких процессах в файл пишут все, а закрывает сегменты только один
+        self.rotate = True
+        self.shared = False
+        self._lock = None
+        self._full = None
+
+    def write(self, user_id: int, action: str):
+        self._buffer.append(json.dumps({
+            "user_id": user_id,
+            "action": action,
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }, ensure_ascii=False) + "\n")
+        if self._full is not None and len(self._buffer) >= self.max_buffer:
+            self._full.set()
+
+    def closed_segments(self) -> list:
+        return sorted(glob.glob(f"{self._base}-[0-9]*{self._ext}.gz"))
+
+    def _read_segment_start(self) -> float:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                first = json.loads(f.readline())
+            return datetime.strptime(first["timestamp"], "%Y-%m-%d %H:%M:%S").timestamp()
+        except Exception:
+            return time.time()
+
+    def _rotate(self):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        closed = f"{self._base}-{stamp}{self._ext}"
+        os.replace(self.path, closed)
+        if self.shared:
+            # Даём другим процессам дописать пачки, начатые до переименования
+            time.sleep(self.flush_interval + 1)
+        with open(closed, "rb") as src, gzip.open(closed + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(closed)
+        logging.info(f"Сегмент журнала событий закрыт: {os.path.basename(closed)}.gz")
+
+    def _maybe_rotate(self):
+        if not self.rotate:
+            return
+        if not os.path.exists(self.path):
+            self._segment_started = time.time()
+            return
+        if self._segment_started is None:
+            self._segment_started = self._read_segment_start()
+        too_big = os.path.getsize(self.path) >= self.max_bytes
+        too_old = time.time() - self._segment_started >= self.max_age
+        if too_big or too_old:
+            self._rotate()
+            self._segment_started = time.time()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        async with self._lock:
+            batch, self._buffer = self._buffer, []
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._maybe_rotate)
+                async with aiofiles.open(self.path, "a", encoding="utf-8") as f:
+                    await f.write("".join(batch))
+            except Exception as e:
+                logging.error(f"Ошибка при записи {len(batch)} событий в журнал: {e}")
+                self._buffer[:0] = batch
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+            if self.shared and self.rotate:
+                # Сегменты закрывает этот процесс, даже если сам он событий не пишет
+                async with self._lock:
+                    await asyncio.get_running_loop().run_in_executor(None, self._maybe_rotate)
+
+    def start(self):
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        run_in_background(self.run())
+
+    def _write_segment(self, events: list):
+        first = datetime.strptime(events[0]["timestamp"], "%Y-%m-%d %H:%M:%S")
+        path = f"{self._base}-{first.strftime('%Y%m%d-%H%M%S-%f')}{self._ext}.gz"
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    async def import_segment(self, events: list):
+        """Сохраняет готовые события отдельным закрытым сегментом."""
+        await asyncio.get_running_loop().run_in_executor(None, self._write_segment, events)
+
+    def _export(self, export_path: str):
+        # gzip допускает склейку потоков, поэтому закрытые сегменты копируются без пересжатия
+        with open(export_path, "wb") as dst:
+            for segment in self.closed_segments():
+                with open(segment, "rb") as src:
+                    shutil.copyfileobj(src, dst)
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as src, gzip.GzipFile(fileobj=dst, mode="wb", mtime=0) as gz:
+                    shutil.copyfileobj(src, gz)
+
+    async def export(self) -> str:
+        """Собирает все сегменты в один .jsonl.gz и возвращает путь к нему."""
+        await self.flush()
+        export_path = f"{self._base}-export{self._ext}.gz"
+        async with self._lock:
+            await asyncio.get_running_loop().run_in_executor(None, self._export, export_path)
+        return export_path
+
+event_log = EventLog(EVENTS_FILE, EVENTS_ROTATE_BYTES, EVENTS_ROTATE_AGE, EVENTS_FLUSH_INTERVAL)
+
+# ==== Кэш участников ====
+class BloomFilter:
+    """Множество целых ключей без ложноотрицательных ответов."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: int):
+        digest = hashlib.blake2b(key.to_bytes(8, "little", signed=True), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: int):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: int) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+class UserCache:
+    """Bloom-фильтр всех user_id и LRU с днём последнего /start перед таблицей users."""
+
+    def __init__(self, bloom_capacity: int, lru_size: int):
+        self.bloom = BloomFilter(bloom_capacity)
+        self.lru_size = lru_size
+        self._recent = OrderedDict()
+
+    async def load(self):
+        def _load_user_cache(conn):
+            count = 0
+            for (user_id,) in conn.execute('SELECT user_id FROM users'):
+                self.bloom.add(user_id)
+                count += 1
+            return count
+        count = await db.run(_load_user_cache)
+        logging.info(f"Кэш пользователей загружен: {count} пользователей")
+
+    def remember(self, user_id: int, day: str):
+        self.bloom.add(user_id)
+        self._recent[user_id] = day
+        self._recent.move_to_end(user_id)
+        if len(self._recent) > self.lru_size:
+            self._recent.popitem(last=False)
+
+    def lookup(self, user_id: int) -> tuple:
+        """(точно новый, день последнего /start или None, если неизвестен)."""
+        if user_id in self._recent:
+            self._recent.move_to_end(user_id)
+            return False, self._recent[user_id]
+        return user_id not in self.bloom, None
+
+user_cache = UserCache(USER_BLOOM_CAPACITY, USER_CACHE_SIZE)
+
+async def save_log(user_id, action):
+    event_log.write(user_id, action)
+
+# ==== Проверка подписки на канал ====
+def is_channel_member(member) -> bool:
+    if member.status in ("creator", "administrator", "member"):
+        return True
+    return member.status == "restricted" and member.is_member
+
+class SubscriptionCache:
+    """Подписан ли пользователь на канал: ответы getChatMember на ttl или negative_ttl секунд."""
+
+    def __init__(self, chat_id: str, ttl: float, negative_ttl: float, max_size: int):
+        self.chat_id = chat_id
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # user_id -> (подписан, срок годности); старые записи в начале
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def is_channel(self, chat) -> bool:
+        return self.chat_id in (str(chat.id), f"@{chat.username}")
+
+    def _store(self, user_id: int, subscribed: bool, ttl: float):
+        self._entries.pop(user_id, None)
+        self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def update(self, user_id: int, subscribed: bool):
+        """Статус из обновления chat_member; ответ запроса, который ещё идёт, уже устарел."""
+        self._pending.pop(user_id, None)
+        self._store(user_id, subscribed, self.ttl if subscribed else self.negative_ttl)
+
+    async def _fetch(self, user_id: int) -> bool:
+        task = asyncio.current_task()
+        try:
+            subscribed = is_channel_member(await bot.get_chat_member(self.chat_id, user_id))
+            ttl = self.ttl if subscribed else self.negative_ttl
+            result = "member" if subscribed else "not_member"
+        except Exception as e:
+            logging.warning(f"Не удалось проверить подписку пользователя {user_id} на канал: {e}")
+            # Ошибка настройки канала не должна закрывать бонусы всем
+            subscribed, ttl, result = True, self.negative_ttl, "error"
+        metrics.SUBSCRIPTION_CHECKS.labels(result).inc()
+        if self._pending.get(user_id) is task:
+            self._store(user_id, subscribed, ttl)
+        return subscribed
+
+    async def is_subscribed(self, user_id: int, refresh: bool = False) -> bool:
+        """refresh=True пропускает кэш, например когда пользователь нажал «Я подписался»."""
+        if not self.chat_id or user_id == ADMIN_ID:
+            return True
+        if not refresh:
+            entry = self._entries.get(user_id)
+            if entry and entry[1] > time.monotonic():
+                metrics.SUBSCRIPTION_CHECKS.labels("cached").inc()
+                return entry[0]
+        # Одновременные проверки одного пользователя ждут один запрос к API
+        task = self._pending.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(user_id))
+            self._pending[user_id] = task
+            task.add_done_callback(lambda t: self._pending.get(user_id) is t and self._pending.pop(user_id))
+        else:
+            metrics.SUBSCRIPTION_CHECKS.labels("coalesced").inc()
+        # Отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+subscriptions = SubscriptionCache(
+    CHANNEL_USERNAME_OR_ID, SUBSCRIPTION_TTL, SUBSCRIPTION_NEGATIVE_TTL, SUBSCRIPTION_CACHE_SIZE
+)
+
+# ==== Кэш файлов Telegram ====
+def _message_file_id(message: Message):
+    if message.photo:
+        return message.photo[-1].file_id
+    media = message.document or message.video or message.animation or message.audio
+    return media.file_id if media else None
+
+class MediaCache:
+    """file_id постоянных файлов (фото приветствия), уже загруженных в Telegram."""
+
+    def __init__(self):
+        self._file_ids = {}
+        self._uploads = {}
+
+    async def load(self):
+        def _load_media_cache(conn):
+            with conn:
+                # Отчёты и логи прежних версий: они не повторяются, их file_id не нужны
+                conn.execute("DELETE FROM media_cache WHERE key LIKE 'document:%'")
+            return dict(conn.execute('SELECT key, file_id FROM media_cache'))
+        self._file_ids = await db.run(_load_media_cache)
+
+    async def _get(self, key: str):
+        if key not in self._file_ids:
+            # file_id мог сохранить другой процесс бота
+            row = await db.fetchone('SELECT file_id FROM media_cache WHERE key = ?', (key,))
+            if not row:
+                return None
+            self._file_ids[key] = row[0]
+        return self._file_ids[key]
+
+    async def _remember(self, key: str, file_id: str):
+        self._file_ids[key] = file_id
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        await db.execute('''INSERT INTO media_cache (key, file_id, updated_at) VALUES (?, ?, ?)
+                            ON CONFLICT (key) DO UPDATE SET
+                                file_id = excluded.file_id,
+                                updated_at = excluded.updated_at''',
+                         (key, file_id, now))
+
+    async def _forget(self, key: str):
+        self._file_ids.pop(key, None)
+        await db.execute('DELETE FROM media_cache WHERE key = ?', (key,))
+
+    async def send(self, key: str, source, send) -> Message:
+        """send(media) отправляет file_id или source и возвращает сообщение."""
+        file_id = await self._get(key)
+        if file_id:
+            try:
+                return await send(file_id)
+            except TelegramBadRequest as e:
+                if "file" not in str(e).lower():
+                    raise
+                logging.warning(f"file_id для {key} больше не действует, отправляю заново: {e}")
+                await self._forget(key)
+
+        # Одновременные отправки ждут первую загрузку, а не загружают файл каждая.
+        # Блокировка нужна только на время загрузки: потом file_id уже известен
+        lock = self._uploads.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                file_id = self._file_ids.get(key)
+                if not file_id:
+                    message = await send(source)
+                    file_id = _message_file_id(message)
+                    if file_id:
+                        try:
+                            await self._remember(key, file_id)
+                        except Exception as e:
+                            logging.error(f"Ошибка при сохранении file_id для {key}: {e}")
+                    return message
+        finally:
+            if self._uploads.get(key) is lock and not lock.locked():
+                del self._uploads[key]
+        return await send(file_id)
+
+media_cache = MediaCache()
+
+# ==== Перенос данных из JSON-файлов ====
+async def migrate_legacy_files():
+    """Однократно переносит users.json, logs.json и stats.json в базу и журнал событий."""
+    logs = {}
+    if os.path.exists(LOGS_FILE):
+        try:
+            async with aiofiles.open(LOGS_FILE, "r", encoding="utf-8") as f:
+                content = await f.read()
+            logs = json.loads(content) if content else {}
+            events = sorted(
+                (
+                    {"user_id": int(user_id), "action": entry["action"], "timestamp": entry["timestamp"]}
+                    for user_id, entries in logs.items()
+                    for entry in entries
+                ),
+                key=lambda event: event["timestamp"]
+            )
+            if events:
+                await event_log.import_segment(events)
+            os.replace(LOGS_FILE, LOGS_FILE + ".migrated")
+            logging.info(f"Перенесено {len(events)} событий из {os.path.basename(LOGS_FILE)}")
+        except Exception as e:
+            logging.error(f"Ошибка при переносе {os.path.basename(LOGS_FILE)}: {e}")
+
+    await button_stats.import_legacy_file()
+
+    if os.path.exists(USERS_FILE):
+        try:
+            async with aiofiles.open(USERS_FILE, "r", encoding="utf-8") as f:
+                content = await f.read()
+            user_ids = json.loads(content) if content else []
+            rows = []
+            for user_id in user_ids:
+                # Дата регистрации - время первого события пользователя, если оно есть
+                entries = logs.get(str(user_id)) or [{}]
+                joined = min(entry.get("timestamp", "") for entry in entries) or None
+                rows.append((user_id, joined, joined))
+            added = await db.executemany(
+                'INSERT OR IGNORE INTO users (user_id, joined_date, last_activity) VALUES (?, ?, ?)',
+                rows
+            )
+            os.replace(USERS_FILE, USERS_FILE + ".migrated")
+            logging.info(f"Перенесено {added} новых пользователей из {os.path.basename(USERS_FILE)}")
+        except Exception as e:
+            logging.error(f"Ошибка при переносе {os.path.basename(USERS_FILE)}: {e}")
 
 # ==== Функции для работы со статистикой ====
-async def update_button_stats(button_name: str):
-    try:
-        stats = {}
-        if os.path.exists(STATS_FILE):
+class ButtonStats:
+    """Счётчики нажатий кнопок в памяти, приращения сохраняются раз в interval секунд."""
+
+    UPSERT = '''INSERT INTO button_clicks (button, day, clicks) VALUES (?, ?, ?)
+                ON CONFLICT (button, day) DO UPDATE SET clicks = clicks + excluded.clicks'''
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.totals = Counter()
+        self.daily = defaultdict(Counter)
+        self._delta = Counter()
+        # Пары (кнопка, пользователь) для сегментов рассылки
+        self._user_clicks = set()
+        # При нескольких процессах счётчики после сохранения перечитываются из базы
+        self.shared = False
+
+    def hit(self, button: str, user_id: int = None):
+        day = date.today().isoformat()
+        self.totals[button] += 1
+        self.daily[day][button] += 1
+        self._delta[(button, day)] += 1
+        if user_id is not None:
+            self._user_clicks.add((button, user_id))
+
+    def today(self) -> Counter:
+        return self.daily.get(date.today().isoformat(), Counter())
+
+    async def load(self):
+        totals, daily = Counter(), defaultdict(Counter)
+        for button, day, clicks in await db.fetchall('SELECT button, day, clicks FROM button_clicks'):
+            totals[button] += clicks
+            daily[day][button] += clicks
+        # Нажатия, ещё не сохранённые в базу, остаются в счётчиках
+        for (button, day), clicks in self._delta.items():
+            totals[button] += clicks
+            daily[day][button] += clicks
+        self.totals, self.daily = totals, daily
+
+    async def import_legacy_file(self):
+        """Переносит счётчики из stats.json; день нажатий там не хранился."""
+        if not os.path.exists(STATS_FILE):
+            return
+        try:
             async with aiofiles.open(STATS_FILE, "r", encoding="utf-8") as f:
                 content = await f.read()
-                if content:
-                    stats = json.loads(content)
-        
-        if button_name not in stats:
-            stats[button_name] = 0
-        stats[button_name] += 1
-        
-        async with aiofiles.open(STATS_FILE, "w", encoding="utf-8") as f:
-            await f.write(json.dumps(stats, ensure_ascii=False, indent=2))
-            
-        logging.info(f"Обновлена статистика для кнопки {button_name}: {stats[button_name]} нажатий")
-    except Exception as e:
-        logging.error(f"Ошибка при обновлении статистики кнопки {button_name}: {e}")
+            stats = json.loads(content) if content else {}
+            day = date.fromtimestamp(os.path.getmtime(STATS_FILE)).isoformat()
+            await db.executemany(self.UPSERT, [(button, day, clicks) for button, clicks in stats.items()])
+            os.replace(STATS_FILE, STATS_FILE + ".migrated")
+            logging.info(f"Статистика кнопок перенесена из {os.path.basename(STATS_FILE)} в базу данных")
+        except Exception as e:
+            logging.error(f"Ошибка при переносе статистики кнопок: {e}")
+
+    async def flush(self):
+        if not self._delta and not self._user_clicks:
+            return
+        delta, self._delta = self._delta, Counter()
+        user_clicks, self._user_clicks = self._user_clicks, set()
+
+        def _save_button_clicks(conn):
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            with conn:
+                conn.executemany(self.UPSERT, [(button, day, n) for (button, day), n in delta.items()])
+                conn.executemany('INSERT OR IGNORE INTO user_buttons (button, user_id) VALUES (?, ?)', user_clicks)
+                c = conn.executemany(
+                    'UPDATE users SET first_click = ? WHERE user_id = ? AND first_click IS NULL',
+                    [(now, user_id) for user_id in {user_id for _, user_id in user_clicks}]
+                )
+                _bump_daily_stats(conn, now[:10], {"clickers": c.rowcount})
+
+        try:
+            await db.run(_save_button_clicks)
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении статистики кнопок: {e}")
+            self._delta.update(delta)
+            self._user_clicks |= user_clicks
+            return
+        if self.shared:
+            await self.load()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        run_in_background(self.run())
+
+button_stats = ButtonStats(STATS_FLUSH_INTERVAL)
+
+async def update_button_stats(button_name: str, user_id: int = None):
+    button_stats.hit(button_name, user_id)
+
+def format_button_stats() -> str:
+    if not button_stats.totals:
+        return "📈 Нажатий кнопок пока нет."
+    today = button_stats.today()
+    lines = ["📈 <b>Статистика кнопок</b>", "<i>всего / сегодня</i>\n"]
+    for button, clicks in button_stats.totals.most_common():
+        lines.append(f"• {html.escape(button)}: {clicks} / {today[button]}")
+    return "\n".join(lines)
+
+def _percent(part: int, whole: int) -> str:
+    return f"{part * 100 / whole:.1f}%" if whole else "-"
+
+async def format_instant_stats() -> str:
+    """Сводка для админ-панели по таблице daily_stats, без обхода users."""
+    week = await get_daily_stats(7)
+    totals = await get_stats_totals()
+    today = date.today()
+    promo = f"{PROMO_CAMPAIGN}_sent"
+
+    lines = ["📊 <b>Статистика</b>\n", "<i>день: новые / активные / промокоды / нажали кнопку</i>"]
+    for offset in range(7):
+        day = (today - timedelta(days=offset)).isoformat()
+        stats = week.get(day, Counter())
+        lines.append(
+            f"{day}: {stats['new_users']} / {stats['active_users']} / {stats[promo]} / {stats['clickers']}"
+        )
+
+    started = totals["new_users"]
+    lines += [
+        "",
+        "<b>Воронка за всё время</b>",
+        f"▶️ /start: {started}",
+        f"🎁 Получили промокод: {totals[promo]} ({_percent(totals[promo], started)})",
+        f"👆 Нажали кнопку: {totals['clickers']} ({_percent(totals['clickers'], started)})",
+    ]
+    clicks_today = button_stats.today()
+    if clicks_today:
+        lines += ["", "<b>Нажатия сегодня</b>"]
+        lines += [f"• {html.escape(button)}: {clicks}" for button, clicks in clicks_today.most_common()]
+    return "\n".join(lines)
+
+# ==== Данные inline-кнопок ====
+# У каждой группы кнопок свой префикс, поэтому callback попадает в нужный
+# обработчик по первой проверке фильтра, а действие выбирается по словарю
+class ButtonCallback(CallbackData, prefix="btn"):
+    """Кнопка приветствия; name - ключ текста кнопки и статистики нажатий."""
+    name: str
+
+class AdminCallback(CallbackData, prefix="admin"):
+    action: str
+    value: str = ""
+
+class BroadcastCallback(CallbackData, prefix="broadcast"):
+    action: str
+    value: str = ""
+
+class SubscriptionCallback(CallbackData, prefix="sub"):
+    action: str
+
+# ==== Тексты и клавиатуры ====
+# Строятся один раз при запуске: модели aiogram неизменяемы, и обработчики
+# переиспользуют их, не создавая и не проверяя заново на каждое обновление.
+# Пользователь получает тексты на своём языке (language_code), если есть перевод
+DEFAULT_LANGUAGE = "ru"
+
+TEXTS = {
+    "ru": {
+        "welcome": (
+            "<b>Привет!</b> Я <b>Сева Дмитренко</b>, и если ты здесь – значит, "
+            "тебе интересно, <i>как использовать нейросети в свою пользу</i>.\n\n"
+            "Я не буду грузить тебя скучными лекциями – лучше сразу покажу, "
+            "что ты можешь сделать с AI уже сегодня.\n\n"
+            "<b>Ты узнаешь:</b>\n"
+            "• Как ускорять работу с текстом и контентом в разы\n"
+            "• Как использовать AI для заработка и автоматизации\n"
+            "• Какие инструменты реально работают, а какие – просто хайп\n\n"
+            "❌ Если тебе кажется, что AI – это сложно, забудь про этот миф. "
+            "Я научу тебя использовать <b>умные технологии</b> без лишней теории.\n\n"
+            "🚀 <b>Выбирай нужный раздел ниже!</b>"
+        ),
+        "unknown": (
+            "❌ Я не знаю такой команды.\n\n"
+            "💬 Хотите пообщаться с AI? Нажмите кнопку ниже!"
+        ),
+        "error": "Произошла ошибка. Пожалуйста, попробуйте позже.",
+        "throttled": "⏳ Слишком часто, подождите пару секунд.",
+        "promo": (
+            f"🎉 Поздравляю! Ты можешь получить скидку <b>15%</b> на тарифы GPT!\n\n"
+            f"🔑 <b>Твой промокод:</b> <code>{PROMO_CODE}</code>\n"
+            f"💡 Используй этот код при покупке, чтобы получить скидку."
+        ),
+        "subscribe_hint": "🔒 <b>Подпишись на канал</b>, чтобы открыть бонусы и получить промокод.",
+        "promo_locked": (
+            "🎁 Твой промокод на скидку <b>15%</b> уже готов!\n\n"
+            "🔒 Чтобы его получить, подпишись на канал и нажми «Я подписался»."
+        ),
+        "subscribed": "✅ Подписка подтверждена!",
+        "not_subscribed": "Подписка пока не видна. Подпишись на канал и нажми кнопку ещё раз.",
+        "btn_check_subscription": "✅ Я подписался",
+        "btn_channel": "🔥 Вступить в закрытый ТГ-канал",
+        "btn_gpt": "🤖 Получить бесплатный GPT",
+        "btn_strat": "🚀 Бесплатная страт сессия",
+        "btn_prompts": "📜 Авторские промты для GPT",
+        "btn_chatgpt": "🤖 Бесплатный ChatGPT",
+    },
+    "en": {
+        "welcome": (
+            "<b>Hi!</b> I'm <b>Seva Dmitrenko</b>, and if you're here, you want to know "
+            "<i>how to make neural networks work for you</i>.\n\n"
+            "No boring lectures – I'll show you right away what you can do with AI today.\n\n"
+            "<b>You'll learn:</b>\n"
+            "• How to work with text and content many times faster\n"
+            "• How to use AI to earn money and automate work\n"
+            "• Which tools really work and which are just hype\n\n"
+            "❌ If you think AI is complicated, forget that myth. "
+            "I'll teach you to use <b>smart technology</b> without extra theory.\n\n"
+            "🚀 <b>Pick a section below!</b>"
+        ),
+        "unknown": (
+            "❌ I don't know this command.\n\n"
+            "💬 Want to chat with AI? Tap the button below!"
+        ),
+        "error": "Something went wrong. Please try again later.",
+        "throttled": "⏳ Too fast, please wait a couple of seconds.",
+        "promo": (
+            f"🎉 Congratulations! You can get <b>15%</b> off GPT plans!\n\n"
+            f"🔑 <b>Your promo code:</b> <code>{PROMO_CODE}</code>\n"
+            f"💡 Use this code at checkout to get the discount."
+        ),
+        "subscribe_hint": "🔒 <b>Subscribe to the channel</b> to unlock the bonuses and get a promo code.",
+        "promo_locked": (
+            "🎁 Your <b>15%</b> promo code is ready!\n\n"
+            "🔒 To get it, subscribe to the channel and tap \"I've subscribed\"."
+        ),
+        "subscribed": "✅ Subscription confirmed!",
+        "not_subscribed": "We can't see your subscription yet. Subscribe to the channel and tap the button again.",
+        "btn_check_subscription": "✅ I've subscribed",
+        "btn_channel": "🔥 Join the private Telegram channel",
+        "btn_gpt": "🤖 Get free GPT",
+        "btn_strat": "🚀 Free strategy session",
+        "btn_prompts": "📜 Author's GPT prompts",
+        "btn_chatgpt": "🤖 Free ChatGPT",
+    },
+}
+
+# Кнопки приветствия: ключ текста, ссылка, callback_data для статистики.
+# Без подписки на канал видна только первая
+CHANNEL_INVITE_URL = "https://t.me/+vNg5vVVonNExOWRi"
+START_BUTTONS = [
+    ("btn_channel", CHANNEL_INVITE_URL),
+    ("btn_gpt", f"https://t.me/{GPT_BOT_USERNAME}"),
+    ("btn_strat", f"https://t.me/{MY_USERNAME}"),
+    ("btn_prompts", "https://puddle-speedwell-70f.notion.site/pack-v0-1-1a413b51050180fe8045c303ca4d4869?pvs=4"),
+]
+
+def user_language(user) -> str:
+    code = (user.language_code or "")[:2] if user else ""
+    return code if code in TEXTS else DEFAULT_LANGUAGE
+
+def get_text(key: str, language: str = DEFAULT_LANGUAGE) -> str:
+    return TEXTS[language].get(key) or TEXTS[DEFAULT_LANGUAGE][key]
+
+def _keyboard(rows) -> InlineKeyboardMarkup:
+    """Клавиатура из строк кнопок, заданных словарями полей InlineKeyboardButton."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(**button) for button in row] for row in rows
+    ])
+
+def _user_keyboards(language: str) -> dict:
+    return {
+        "start": _keyboard(
+            [{"text": get_text(key, language), "url": url, "callback_data": ButtonCallback(name=key).pack()}]
+            for key, url in START_BUTTONS
+        ),
+        "subscribe": _keyboard([
+            [{"text": get_text("btn_channel", language), "url": CHANNEL_INVITE_URL}],
+            [{
+                "text": get_text("btn_check_subscription", language),
+                "callback_data": SubscriptionCallback(action="check").pack()
+            }],
+        ]),
+        "unknown": _keyboard([
+            [{"text": get_text("btn_chatgpt", language), "url": f"https://t.me/{GPT_BOT_USERNAME}"}]
+        ]),
+    }
+
+USER_KEYBOARDS = {language: _user_keyboards(language) for language in TEXTS}
+
+# Админ-панель только на русском
+ADMIN_PANEL_TEXT = "⚙️ <b>Админ-панель</b>"
+ADMIN_PANEL_KEYBOARD = _keyboard([
+    [
+        {"text": "📊 Отчёт по пользователям", "callback_data": AdminCallback(action="report", value="xlsx").pack()},
+        {"text": "📄 CSV", "callback_data": AdminCallback(action="report", value="csv").pack()},
+    ],
+    [{"text": "📊 Статистика", "callback_data": AdminCallback(action="stats").pack()}],
+    [{"text": "📈 Статистика кнопок", "callback_data": AdminCallback(action="button_stats").pack()}],
+    [{"text": "📢 Рассылка", "callback_data": AdminCallback(action="broadcast").pack()}],
+    [{"text": "❌ Закрыть", "callback_data": AdminCallback(action="close").pack()}],
+])
+ADMIN_BACK_KEYBOARD = _keyboard([[{"text": "◀️ Назад", "callback_data": AdminCallback(action="return").pack()}]])
+
+# Сегменты рассылки на выбор администратору: название и условия отбора
+BROADCAST_SEGMENTS = {
+    "all": ("Все", lambda: Segment()),
+    "active7": ("Активные за 7 дней", lambda: Segment(active_days=7)),
+    "active30": ("Активные за 30 дней", lambda: Segment(active_days=30)),
+    "new7": ("Новые за 7 дней", lambda: Segment(joined_from=date.today() - timedelta(days=7))),
+    **{
+        key: (f"Нажимали «{get_text(key)}»", lambda key=key: Segment(button=key))
+        for key, _ in START_BUTTONS
+    },
+}
+
+def _broadcast_preview_keyboard(selected: str) -> InlineKeyboardMarkup:
+    return _keyboard([
+        [{
+            "text": ("✔️ " if name == selected else "") + label,
+            "callback_data": BroadcastCallback(action="segment", value=name).pack()
+        }]
+        for name, (label, _) in BROADCAST_SEGMENTS.items()
+    ] + [
+        [{"text": "✅ Подтвердить", "callback_data": BroadcastCallback(action="confirm").pack()}],
+        [{"text": "◀️ Отмена", "callback_data": AdminCallback(action="return").pack()}],
+    ])
+
+BROADCAST_PREVIEW_KEYBOARDS = {name: _broadcast_preview_keyboard(name) for name in BROADCAST_SEGMENTS}
+
+def user_keyboard(name: str, language: str = DEFAULT_LANGUAGE) -> InlineKeyboardMarkup:
+    return USER_KEYBOARDS[language][name]
 
 # ==== Обработчик неизвестных команд ====
-@dp.message(lambda message: not message.text.startswith('/'))
+# Только текст и только вне состояний FSM: текст рассылки от администратора
+# обрабатывает process_broadcast_text, фото и стикеры не обрабатываются
+@dp.message(StateFilter(None), F.text, ~F.text.startswith("/"), flags={"throttle": (0.5, 3)})
 async def handle_unknown(message: Message):
     try:
         await update_user_activity(message.from_user.id)
-        
-        unknown_text = (
-            "❌ Я не знаю такой команды.\n\n"
-            "💬 Хотите пообщаться с AI? Нажмите кнопку ниже!"
-        )
-        
-        kb = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(
-                        text="🤖 Бесплатный ChatGPT",
-                        url=f"https://t.me/{GPT_BOT_USERNAME}"
-                    )
-                ]
-            ]
-        )
-        
-        await message.answer(unknown_text, reply_markup=kb)
+        language = user_language(message.from_user)
+        await message.answer(get_text("unknown", language), reply_markup=user_keyboard("unknown", language))
     except Exception as e:
         logging.error(f"Ошибка в обработчике неизвестных команд: {e}")
-        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
+        await message.answer(get_text("error", user_language(message.from_user)))
 
 # ==== /start ====
-@dp.message(Command("start"))
+@dp.message(Command("start"), flags={"throttle": (0.2, 3)})
 async def cmd_start(message: Message):
     try:
         user_id = message.from_user.id
-        users = await load_users()
+        language = user_language(message.from_user)
+        # Подписка проверяется параллельно с записью в базу
+        subscribed = asyncio.create_task(subscriptions.is_subscribed(user_id))
 
         # Добавляем пользователя в базу данных
-        await add_user(
+        is_new = await add_user(
             user_id=message.from_user.id,
             username=message.from_user.username or "",
             first_name=message.from_user.first_name or "",
-            last_name=message.from_user.last_name or ""
+            last_name=message.from_user.last_name or "",
+            language=language
         )
 
-        # Добавляем пользователя, если его нет
-        if user_id not in users:
-            users.add(user_id)
-            await save_users(users)
+        if is_new:
             await save_log(user_id, "Нажал /start")
 
-        # Создаем кнопки
-        buttons = [
-            ("🔥 Вступить в закрытый ТГ-канал", "https://t.me/+vNg5vVVonNExOWRi", "btn_channel"),
-            ("🤖 Получить бесплатный GPT", f"https://t.me/{GPT_BOT_USERNAME}", "btn_gpt"),
-            ("🚀 Бесплатная страт сессия", f"https://t.me/{MY_USERNAME}", "btn_strat"),
-            ("📜 Авторские промты для GPT", "https://puddle-speedwell-70f.notion.site/pack-v0-1-1a413b51050180fe8045c303ca4d4869?pvs=4", "btn_prompts")
-        ]
-
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=text, url=url, callback_data=callback)]
-            for text, url, callback in buttons
-        ])
-
-        # Полный текст приветствия
-        welcome_text = (
-            "<b>Привет!</b> Я <b>Сева Дмитренко</b>, и если ты здесь – значит, "
-            "тебе интересно, <i>как использовать нейросети в свою пользу</i>.\n\n"
-            "Я не буду грузить тебя скучными лекциями – лучше сразу покажу, "
-            "что ты можешь сделать с AI уже сегодня.\n\n"
-            "<b>Ты узнаешь:</b>\n"
-            "• Как ускорять работу с текстом и контентом в разы\n"
-            "• Как использовать AI для заработка и автоматизации\n"
-            "• Какие инструменты реально работают, а какие – просто хайп\n\n"
-            "❌ Если тебе кажется, что AI – это сложно, забудь про этот миф. "
-            "Я научу тебя использовать <b>умные технологии</b> без лишней теории.\n\n"
-            "🚀 <b>Выбирай нужный раздел ниже!</b>"
-        )
-
-        await message.answer_photo(
-            photo="https://i.postimg.cc/KYThRhy6/image.png",
-            caption=welcome_text,
+        # Без подписки вместо ссылок - кнопка канала и повторной проверки
+        caption = get_text("welcome", language)
+        keyboard = user_keyboard("start", language)
+        if not await subscribed:
+            caption += "\n\n" + get_text("subscribe_hint", language)
+            keyboard = user_keyboard("subscribe", language)
+        await media_cache.send(f"welcome_photo:{WELCOME_PHOTO_URL}", WELCOME_PHOTO_URL, lambda photo: message.answer_photo(
+            photo=photo,
+            caption=caption,
             parse_mode="HTML",
-            reply_markup=kb
-        )
+            reply_markup=keyboard
+        ))
 
-        # Запускаем отправку промокода через PROMO_DELAY
-        asyncio.create_task(send_promo_after_delay(user_id))
+        # Планируем отправку промокода через PROMO_DELAY (один раз на пользователя)
+        await promo_scheduler.schedule(user_id, PROMO_CAMPAIGN, PROMO_DELAY)
     except Exception as e:
         logging.error(f"Ошибка в команде /start: {e}")
-        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
+        await message.answer(get_text("error", user_language(message.from_user)))
 
-async def send_promo_after_delay(chat_id: int):
-    await asyncio.sleep(PROMO_DELAY)
+async def send_promo(chat_id: int) -> str:
+    """Отправляет промокод, а без подписки на канал - просьбу подписаться со статусом locked."""
     try:
-        promo_text = (
-            f"🎉 Поздравляю! Ты можешь получить скидку <b>15%</b> на тарифы GPT!\n\n"
-            f"🔑 <b>Твой промокод:</b> <code>{PROMO_CODE}</code>\n"
-            f"💡 Используй этот код при покупке, чтобы получить скидку."
-        )
-
-        await bot.send_message(chat_id, promo_text, parse_mode="HTML")
+        language = await get_user_language(chat_id)
+        if not await subscriptions.is_subscribed(chat_id):
+            await bot.send_message(
+                chat_id, get_text("promo_locked", language), parse_mode="HTML",
+                reply_markup=user_keyboard("subscribe", language)
+            )
+            await save_log(chat_id, "Промокод ждёт подписки на канал")
+            return "locked"
+        await bot.send_message(chat_id, get_text("promo", language), parse_mode="HTML")
         await save_log(chat_id, "Получил промокод")
+        return "sent"
+    except TelegramRetryAfter:
+        # Паузу выдерживает планировщик
+        raise
+    except Exception as e:
+        error = classify_send_error(e)
+        status = delivery_status(error)
+        if status == "failed":
+            logging.error(f"Ошибка при отправке промокода: {e}")
+        await record_delivery(chat_id, status, error)
+        return status
+
+# ==== Блокировка бота пользователем ====
+@dp.my_chat_member(lambda update: update.chat.type == "private")
+async def track_bot_status(update: ChatMemberUpdated):
+    """Telegram сообщает о блокировке и разблокировке бота, не дожидаясь ошибки отправки."""
+    user_id = update.from_user.id
+    status = update.new_chat_member.status
+    if status == "kicked":
+        await record_delivery(user_id, "blocked", "blocked")
+    elif status == "member":
+        await reactivate_user(user_id)
+
+# ==== Подписка на канал ====
+@dp.chat_member(lambda update: subscriptions.is_channel(update.chat))
+async def track_channel_subscription(update: ChatMemberUpdated):
+    """Подписки и отписки в канале сразу обновляют кэш проверки подписки."""
+    user_id = update.new_chat_member.user.id
+    subscribed = is_channel_member(update.new_chat_member)
+    subscriptions.update(user_id, subscribed)
+    if subscribed:
+        # Промокод, ожидавший подписки, уходит без нажатия «Я подписался»
+        await promo_scheduler.resume(user_id, PROMO_CAMPAIGN)
+
+@dp.callback_query(SubscriptionCallback.filter(F.action == "check"), flags={"throttle": (0.2, 2)})
+async def check_subscription(call: CallbackQuery):
+    try:
+        user_id = call.from_user.id
+        language = user_language(call.from_user)
+        if not await subscriptions.is_subscribed(user_id, refresh=True):
+            await call.answer(get_text("not_subscribed", language), show_alert=True)
+            return
+
+        await call.answer(get_text("subscribed", language))
+        await save_log(user_id, "Подписался на канал")
+        if call.message:
+            try:
+                await call.message.edit_reply_markup(reply_markup=user_keyboard("start", language))
+            except TelegramBadRequest:
+                pass
+        # Промокод, ожидавший подписки, уходит сразу
+        await promo_scheduler.resume(user_id, PROMO_CAMPAIGN)
     except Exception as e:
-        logging.error(f"Ошибка при отправке промокода: {e}")
+        logging.error(f"Ошибка при проверке подписки: {e}")
+        await call.answer(get_text("error", user_language(call.from_user)), show_alert=True)
 
 # ==== /logs ====
 @dp.message(Command("logs"))
@@ -317,16 +1808,21 @@ async def send_logs(message: Message):
         await message.answer("❌ У вас нет доступа к логам.")
         return
 
-    if not os.path.exists(LOGS_FILE):
-        await message.answer("❌ Логов пока нет.")
-        return
-
     try:
-        file_input = FSInputFile(LOGS_FILE)
-        await message.answer_document(
-            document=file_input,
-            caption="Логи пользователей."
-        )
+        # /logs - текущий сегмент, /logs all - все события одним архивом
+        if message.text.split()[1:] == ["all"]:
+            file_path = await event_log.export()
+            caption = "Все логи пользователей."
+        else:
+            await event_log.flush()
+            file_path = EVENTS_FILE
+            caption = "Логи пользователей (текущий сегмент)."
+
+        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+            await message.answer("❌ Логов пока нет.")
+            return
+
+        await message.answer_document(FSInputFile(file_path), caption=caption)
     except Exception as e:
         logging.error(f"Ошибка при отправке логов: {e}")
         await message.answer("❌ Произошла ошибка при отправке логов.")
@@ -343,7 +1839,8 @@ async def cmd_help(message: Message):
         "/start - Начать работу с ботом\n"
         "/help - Показать это сообщение\n"
         "/admin - Админ-панель\n"
-        "/logs - Получить логи\n\n"
+        "/logs - Получить логи текущего сегмента\n"
+        "/logs all - Получить все логи одним архивом\n\n"
         "<b>Функции админ-панели:</b>\n"
         "• Просмотр количества пользователей\n"
         "• Просмотр статистики кнопок\n"
@@ -362,72 +1859,21 @@ async def admin_panel(message: Message):
         await message.answer("❌ У вас нет прав для доступа к админ-панели!")
         return
 
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="📊 Отчёт по пользователям",
-                    callback_data="admin_excel_stats"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="📢 Рассылка",
-                    callback_data="admin_broadcast"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="❌ Закрыть",
-                    callback_data="admin_close"
-                )
-            ]
-        ]
-    )
-    await message.answer("⚙️ <b>Админ-панель</b>", parse_mode="HTML", reply_markup=kb)
+    await message.answer(ADMIN_PANEL_TEXT, parse_mode="HTML", reply_markup=ADMIN_PANEL_KEYBOARD)
 
-@dp.callback_query(lambda c: c.data in ["admin_excel_stats", "admin_broadcast", "admin_close", "admin_return"])
-async def admin_panel_actions(call: CallbackQuery, state: FSMContext):
+@dp.callback_query(AdminCallback.filter())
+async def admin_panel_actions(call: CallbackQuery, callback_data: AdminCallback, state: FSMContext):
     if call.from_user.id != ADMIN_ID:
         await call.answer("❌ Нет доступа!", show_alert=True)
         return
 
-    try:
-        if call.data == "admin_excel_stats":
-            await call.message.edit_text("📊 Создаю отчет...")
-            if await create_excel_report():
-                file = FSInputFile("bot_statistics.xlsx")
-                await call.message.answer_document(file)
-                await return_to_admin_panel(call.message)
-            else:
-                await call.message.edit_text("❌ Ошибка при создании отчета")
-                await asyncio.sleep(2)
-                await return_to_admin_panel(call.message)
-
-        elif call.data == "admin_broadcast":
-            await state.set_state(BroadcastStates.waiting_broadcast_text)
-            kb = InlineKeyboardMarkup(
-                inline_keyboard=[[
-                    InlineKeyboardButton(
-                        text="◀️ Назад",
-                        callback_data="admin_return"
-                    )
-                ]]
-            )
-            await call.message.edit_text(
-                "📢 Введите текст для рассылки:\n"
-                "<i>Поддерживается HTML-разметка</i>",
-                parse_mode="HTML",
-                reply_markup=kb
-            )
-
-        elif call.data == "admin_close":
-            await call.message.delete()
-            
-        elif call.data == "admin_return":
-            await state.clear()
-            await return_to_admin_panel(call.message)
+    action = ADMIN_ACTIONS.get(callback_data.action)
+    if action is None:
+        await call.answer()
+        return
 
+    try:
+        await action(call, callback_data.value, state)
     except Exception as e:
         logging.error(f"Ошибка в админ-панели: {e}")
         await call.message.edit_text("❌ Произошла ошибка при выполнении операции.")
@@ -435,112 +1881,207 @@ async def admin_panel_actions(call: CallbackQuery, state: FSMContext):
         await asyncio.sleep(2)
         await return_to_admin_panel(call.message)
 
-async def return_to_admin_panel(message: Message):
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="📊 Отчёт по пользователям",
-                    callback_data="admin_excel_stats"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="📢 Рассылка",
-                    callback_data="admin_broadcast"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="❌ Закрыть",
-                    callback_data="admin_close"
-                )
-            ]
-        ]
+async def admin_report(call: CallbackQuery, report_format: str, state: FSMContext):
+    if JOBS_IN_SEPARATE_PROCESS:
+        # Отчёт построит процесс заданий, обработчик сразу освобождается
+        await create_report_job(report_format, call.message)
+        await call.message.edit_text("📊 Отчет поставлен в очередь...")
+    else:
+        await deliver_report(report_format, call.message)
+
+async def admin_stats(call: CallbackQuery, value: str, state: FSMContext):
+    await call.message.edit_text(await format_instant_stats(), parse_mode="HTML", reply_markup=ADMIN_BACK_KEYBOARD)
+
+async def admin_button_stats(call: CallbackQuery, value: str, state: FSMContext):
+    await call.message.edit_text(format_button_stats(), parse_mode="HTML", reply_markup=ADMIN_BACK_KEYBOARD)
+
+async def admin_broadcast(call: CallbackQuery, value: str, state: FSMContext):
+    await state.set_state(BroadcastStates.waiting_broadcast_text)
+    await call.message.edit_text(
+        "📢 Введите текст для рассылки:\n"
+        "<i>Поддерживается HTML-разметка</i>",
+        parse_mode="HTML",
+        reply_markup=ADMIN_BACK_KEYBOARD
     )
-    await message.edit_text("⚙️ <b>Админ-панель</b>", parse_mode="HTML", reply_markup=kb)
 
-async def create_excel_report():
-    try:
-        users = await get_users_list()
-        if not users:
-            logging.warning("Нет данных для создания отчета")
-            return False
+async def admin_close(call: CallbackQuery, value: str, state: FSMContext):
+    await call.message.delete()
 
-        users_data = []
-        for user in users:
-            user_id, username, first_name, last_name, joined_date, last_activity = user
-            users_data.append({
-                'ID': user_id,
-                'Username': f"@{username}" if username else 'нет',
-                'Имя': first_name or 'нет',
-                'Фамилия': last_name or 'нет',
-                'Дата регистрации': joined_date,
-                'Последняя активность': last_activity
-            })
+async def admin_return(call: CallbackQuery, value: str, state: FSMContext):
+    await state.clear()
+    await return_to_admin_panel(call.message)
 
-        df_users = pd.DataFrame(users_data)
+# Действия админ-панели: AdminCallback.action -> обработчик(call, value, state)
+ADMIN_ACTIONS = {
+    "report": admin_report,
+    "stats": admin_stats,
+    "button_stats": admin_button_stats,
+    "broadcast": admin_broadcast,
+    "close": admin_close,
+    "return": admin_return,
+}
 
-        # Удаляем старый файл, если он существует
-        if os.path.exists('bot_statistics.xlsx'):
-            os.remove('bot_statistics.xlsx')
+async def return_to_admin_panel(message: Message):
+    await message.edit_text(ADMIN_PANEL_TEXT, parse_mode="HTML", reply_markup=ADMIN_PANEL_KEYBOARD)
+
+# ==== Прогресс долгих операций ====
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} сек"
+    if seconds < 3600:
+        return f"{seconds // 60} мин {seconds % 60} сек"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+def format_eta(done: int, total: int, rate: float) -> str:
+    """Оставшееся время при текущей скорости."""
+    if done >= total:
+        return "0 сек"
+    if rate <= 0:
+        return "неизвестно"
+    return format_duration((total - done) / rate)
+
+class ProgressReporter:
+    """Ход долгой операции в одном сообщении, которое правится не чаще раза в interval секунд."""
+
+    def __init__(self, message: Message, render, total: int = 0, interval: float = PROGRESS_INTERVAL):
+        # render(reporter) возвращает текст сообщения
+        self.message = message
+        self.render = render
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.started = time.monotonic()
+        self._text = message.text
+        self._paused_until = 0.0
+        self._task = None
+
+    def update(self, done: int):
+        self.done = done
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> str:
+        return format_eta(self.done, self.total, self.rate)
+
+    async def edit(self, text: str, **kwargs):
+        """Правит сообщение, если текст изменился; ошибки правки не прерывают операцию."""
+        if text == self._text or time.monotonic() < self._paused_until:
+            return
+        try:
+            await self.message.edit_text(text, **kwargs)
+            self._text = text
+        except TelegramRetryAfter as e:
+            self._paused_until = time.monotonic() + e.retry_after
+            logging.warning(f"Telegram просит подождать {e.retry_after} сек., прогресс не обновлён")
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                self._text = text
+            else:
+                logging.warning(f"Не удалось обновить прогресс: {e}")
+        except Exception as e:
+            logging.warning(f"Не удалось обновить прогресс: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.edit(self.render(self))
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+# ==== Отчёты ====
+REPORT_FILES = {
+    "xlsx": os.path.join(DATA_DIR, "bot_statistics.xlsx"),
+    "csv": os.path.join(DATA_DIR, "bot_statistics.csv.gz"),
+}
+
+def _build_report(report_format: str, path: str, progress=None) -> int:
+    # Модуль отчётов и xlsxwriter загружаются только при первом запросе отчёта
+    reports = importlib.import_module("reports")
+    return reports.write_report(report_format, DB_FILE, path, progress)
+
+async def create_report(report_format: str = "xlsx", progress=None):
+    """Строит отчёт в рабочем потоке и возвращает путь к файлу или None."""
+    path = REPORT_FILES[report_format]
+    tmp_path = f"{path}.tmp"
+    try:
+        count = await asyncio.get_running_loop().run_in_executor(
+            None, _build_report, report_format, tmp_path, progress
+        )
+        if not count:
+            logging.warning("Нет данных для создания отчета")
+            return None
+        os.replace(tmp_path, path)
+        logging.info(f"Отчёт {os.path.basename(path)} создан: {count} пользователей")
+        return path
+    except Exception as e:
+        logging.error(f"Ошибка при создании отчета {report_format}: {e}")
+        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def format_report_progress(reporter: ProgressReporter) -> str:
+    return (
+        f"📊 Создаю отчет...\n"
+        f"Выгружено {reporter.done} из {reporter.total} пользователей\n"
+        f"⚡ Скорость: {reporter.rate:.0f} строк/сек\n"
+        f"⏳ Осталось: {reporter.eta}"
+    )
 
-        writer = pd.ExcelWriter('bot_statistics.xlsx', engine='xlsxwriter')
-        df_users.to_excel(writer, sheet_name='Пользователи', index=False)
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Пользователи']
-        
-        # Форматирование заголовков
-        header_format = workbook.add_format({
-            'bold': True,
-            'text_wrap': True,
-            'valign': 'top',
-            'fg_color': '#D7E4BC',
-            'border': 1
-        })
-        
-        # Форматирование ячеек
-        cell_format = workbook.add_format({
-            'text_wrap': True,
-            'valign': 'top',
-            'border': 1
-        })
-        
-        # Применяем форматирование
-        for col_num, value in enumerate(df_users.columns.values):
-            worksheet.write(0, col_num, value, header_format)
-            worksheet.set_column(col_num, col_num, 15, cell_format)
-            
-            # Устанавливаем ширину колонок
-            max_length = max(
-                df_users[value].astype(str).apply(len).max(),
-                len(str(value))
-            )
-            worksheet.set_column(col_num, col_num, max_length + 2)
-        
-        writer.close()
-        
-        if not os.path.exists('bot_statistics.xlsx'):
-            logging.error("Файл отчета не был создан")
-            return False
-            
+async def deliver_report(report_format: str, message: Message):
+    """Строит отчёт и отправляет его в чат админ-панели."""
+    await message.edit_text("📊 Создаю отчет...")
+    total = (await db.fetchone('SELECT COUNT(*) FROM users'))[0]
+    reporter = ProgressReporter(message, format_report_progress, total)
+    reporter.start()
+    try:
+        report_path = await create_report(report_format, reporter.update)
+    finally:
+        await reporter.stop()
+    if report_path:
+        await message.answer_document(FSInputFile(report_path))
+        await return_to_admin_panel(message)
         return True
-    except Exception as e:
-        logging.error(f"Ошибка при создании Excel отчета: {e}")
-        return False
+    await message.edit_text("❌ Ошибка при создании отчета")
+    await asyncio.sleep(2)
+    await return_to_admin_panel(message)
+    return False
 
-# ==== Обработчик для всех inline кнопок ====
-@dp.callback_query()
-async def process_callback(call: CallbackQuery):
+async def run_report_job(job_id: int, report_format: str, message: Message):
+    try:
+        done = await deliver_report(report_format, message)
+    except asyncio.CancelledError:
+        # Задание останется running и вернётся в очередь при следующем запуске
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка при выполнении отчёта #{job_id}: {e}")
+        done = False
+        try:
+            await message.edit_text("❌ Ошибка при создании отчета")
+        except Exception:
+            pass
+    await finish_report_job(job_id, "done" if done else "failed")
+
+# ==== Обработчик кнопок приветствия ====
+@dp.callback_query(ButtonCallback.filter())
+async def process_callback(call: CallbackQuery, callback_data: ButtonCallback):
     try:
-        # Пропускаем системные callback_data
-        if call.data.startswith(('admin_', 'broadcast_')):
-            return
-            
         # Логируем нажатие кнопки
-        await update_button_stats(call.data)
-        logging.info(f"Пользователь {call.from_user.id} нажал кнопку {call.data}")
+        await update_button_stats(callback_data.name, call.from_user.id)
+        logging.info(f"Пользователь {call.from_user.id} нажал кнопку {callback_data.name}",
+                     extra={"user_id": call.from_user.id, "sample": "button_click"})
         
         # Отвечаем пользователю, чтобы убрать часы загрузки
         await call.answer()
@@ -549,100 +2090,552 @@ async def process_callback(call: CallbackQuery):
         logging.error(f"Ошибка при обработке нажатия кнопки: {e}")
         await call.answer("Произошла ошибка", show_alert=True)
 
+# ==== Движок рассылки ====
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов всем отправителям (ответ 429 от Telegram)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class ChatRateLimiter:
+    """Выдерживает минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, interval: float, max_size: int = 10000):
+        self.interval = interval
+        self.max_size = max_size
+        self._last_sent = {}
+
+    async def wait(self, chat_id: int):
+        now = time.monotonic()
+        last = self._last_sent.get(chat_id)
+        if last is not None and now - last < self.interval:
+            await asyncio.sleep(self.interval - (now - last))
+            now = time.monotonic()
+        self._last_sent[chat_id] = now
+
+        if len(self._last_sent) > self.max_size:
+            # Чаты, в которые писали дольше интервала назад, больше не ограничены
+            self._last_sent = {
+                cid: ts for cid, ts in self._last_sent.items()
+                if now - ts < self.interval
+            }
+
+@dataclass
+class BroadcastResult:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    retries: int = 0
+    # Ошибки доставки по типам classify_send_error
+    errors: Counter = field(default_factory=Counter)
+    # Сколько получателей было обработано до перезапуска задания
+    resumed: int = 0
+    started: float = field(default_factory=time.monotonic)
+    finished: float = None
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        """Реальная скорость рассылки, сообщений в секунду."""
+        elapsed = self.elapsed
+        return (self.processed - self.resumed) / elapsed if elapsed > 0 else 0.0
+
+class BroadcastEngine:
+    """Рассылка пулом параллельных отправителей за общим token bucket."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float = BROADCAST_RATE,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        per_chat_interval: float = BROADCAST_PER_CHAT_INTERVAL
+    ):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate)
+        self.chat_limiter = ChatRateLimiter(per_chat_interval)
+
+    async def send(self, chat_id: int, text: str, parse_mode: str, result: BroadcastResult) -> tuple:
+        """Отправляет одно сообщение и возвращает (sent, blocked или failed, тип ошибки)."""
+        for _ in range(BROADCAST_MAX_RETRIES):
+            await self.chat_limiter.wait(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, parse_mode=parse_mode)
+                return "sent", None
+            except TelegramRetryAfter as e:
+                # Лимит превышен для всего бота: ставим на паузу всю очередь
+                result.retries += 1
+                metrics.BROADCAST_RETRIES.inc()
+                logging.warning(f"Telegram просит подождать {e.retry_after} сек., рассылка на паузе")
+                self.bucket.pause(e.retry_after)
+            except Exception as e:
+                error = classify_send_error(e)
+                status = delivery_status(error)
+                if status == "blocked":
+                    # Мёртвые чаты - обычное дело на старой аудитории, пишем выборочно
+                    logging.info(f"Чат {chat_id} недоступен ({error}): {e}",
+                                    extra={"user_id": chat_id, "sample": "dead_chat"})
+                else:
+                    logging.error(f"Ошибка при отправке сообщения пользователю {chat_id}: {e}")
+                return status, error
+        logging.error(f"Не удалось отправить сообщение пользователю {chat_id}: превышено число повторов")
+        return "failed", "retry_after"
+
+    async def run(
+        self,
+        chat_ids,
+        text: str,
+        parse_mode: str = None,
+        result: BroadcastResult = None,
+        on_result=None
+    ) -> BroadcastResult:
+        """chat_ids - итерируемый или асинхронно итерируемый, on_result(chat_id, status, error)."""
+        result = result or BroadcastResult()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                if chat_id is None:
+                    return
+                status, error = await self.send(chat_id, text, parse_mode, result)
+                setattr(result, status, getattr(result, status) + 1)
+                if error:
+                    result.errors[error] += 1
+                metrics.BROADCAST_MESSAGES.labels(status).inc()
+                if on_result:
+                    await on_result(chat_id, status, error)
+
+        async def produce():
+            if hasattr(chat_ids, "__aiter__"):
+                async for chat_id in chat_ids:
+                    await queue.put(chat_id)
+            else:
+                for chat_id in chat_ids:
+                    await queue.put(chat_id)
+            for _ in workers:
+                await queue.put(None)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        producer = asyncio.create_task(produce())
+        try:
+            # Ошибка в отправителе (например, on_result не смог сохранить результат)
+            # прерывает рассылку, иначе очередь переполнится и producer зависнет
+            await asyncio.gather(producer, *workers)
+        finally:
+            for task in [producer, *workers]:
+                task.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+            result.finished = time.monotonic()
+
+        logging.info(
+            f"Рассылка завершена: отправлено {result.sent}, ошибок {result.failed}, "
+            f"недоступны {result.blocked}, повторов {result.retries}, "
+            f"ошибки {dict(result.errors)}, "
+            f"{result.rate:.1f} сообщ./сек за {result.elapsed:.1f} сек"
+        )
+        return result
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def stop_background_tasks():
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+def format_broadcast_status(title: str, result: BroadcastResult, eta: bool = False) -> str:
+    text = (
+        f"{title}\n"
+        f"✅ Отправлено: {result.sent}\n"
+        f"❌ Ошибок: {result.failed}\n"
+        f"🚫 Недоступны (блок, удалён аккаунт): {result.blocked}\n"
+        f"⚡ Скорость: {result.rate:.1f} сообщ./сек"
+    )
+    if eta:
+        text += (
+            f"\n📬 Обработано {result.processed} из {result.total}"
+            f"\n⏳ Осталось: {format_eta(result.processed, result.total, result.rate)}"
+        )
+    return text
+
+class BroadcastCheckpoint:
+    """Копит результаты доставки и сохраняет их в базу пачками."""
+
+    def __init__(self, job_id: int, batch_size: int = BROADCAST_CHECKPOINT_SIZE):
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self._pending = []
+
+    async def add(self, chat_id: int, status: str, error: str = None):
+        self._pending.append((chat_id, status, error))
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            await save_recipient_statuses(self.job_id, batch)
+        except Exception:
+            # Пачка возвращается в начало очереди и сохранится со следующей
+            self._pending[:0] = batch
+            raise
+
+async def run_broadcast(job_id: int, text: str, parse_mode: str, status_message: Message):
+    """Выполняет задание рассылки в фоне, продолжая с последней контрольной точки."""
+    progress = await get_broadcast_progress(job_id)
+    result = BroadcastResult(
+        total=sum(progress.values()),
+        sent=progress.get("sent", 0),
+        failed=progress.get("failed", 0),
+        blocked=progress.get("blocked", 0)
+    )
+    result.resumed = result.processed
+    chat_ids = iter_pending_recipients(job_id)
+
+    checkpoint = BroadcastCheckpoint(job_id)
+    finished = False
+    engine = BroadcastEngine(bot)
+    reporter = ProgressReporter(
+        status_message,
+        lambda _: format_broadcast_status(f"📢 Рассылка #{job_id} в процессе...", result, eta=True)
+    )
+    reporter.start()
+    broadcast = asyncio.create_task(
+        engine.run(chat_ids, text, parse_mode=parse_mode, result=result, on_result=checkpoint.add)
+    )
+    try:
+        await broadcast
+        await reporter.stop()
+        await checkpoint.flush()
+        await finish_broadcast_job(job_id)
+        finished = True
+
+        await status_message.edit_text(
+            format_broadcast_status(f"📢 Рассылка #{job_id} завершена.", result)
+        )
+        await asyncio.sleep(3)
+        await return_to_admin_panel(status_message)
+    except asyncio.CancelledError:
+        logging.info(f"Рассылка #{job_id} прервана, прогресс сохранён")
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка при выполнении рассылки #{job_id}: {e}")
+        if not finished:
+            # Приостановленное задание продолжит resume_broadcasts или процесс заданий
+            await finish_broadcast_job(job_id, "paused")
+        await status_message.edit_text(
+            f"⏸ Рассылка #{job_id} приостановлена из-за ошибки и будет продолжена с места остановки."
+        )
+    finally:
+        await reporter.stop()
+        broadcast.cancel()
+        await asyncio.gather(broadcast, return_exceptions=True)
+        # Сохраняем то, что успели отправить, чтобы при возобновлении не слать повторно
+        try:
+            await checkpoint.flush()
+        except Exception:
+            # Ошибка уже записана в лог; несохранённые получатели остались pending
+            pass
+
+def job_status_message(chat_id: int, message_id: int) -> Message:
+    """Сообщение админ-панели, сохранённое в задании, для правки из другого процесса."""
+    return Message(
+        message_id=message_id,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type="private")
+    ).as_(bot)
+
+async def start_broadcast_job(job_id: int, text: str, parse_mode: str, chat_id: int, message_id: int) -> asyncio.Task:
+    if chat_id and message_id:
+        status_message = job_status_message(chat_id, message_id)
+        await status_message.edit_text(f"📢 Продолжаю рассылку #{job_id}...")
+    else:
+        status_message = await bot.send_message(ADMIN_ID, f"📢 Продолжаю рассылку #{job_id}...")
+    return run_in_background(run_broadcast(job_id, text, parse_mode, status_message))
+
+async def resume_broadcasts():
+    """Возобновляет рассылки, прерванные остановкой бота."""
+    for job in await get_unfinished_broadcast_jobs():
+        logging.info(f"Возобновляю рассылку #{job[0]}")
+        try:
+            await start_broadcast_job(*job)
+        except Exception as e:
+            logging.error(f"Не удалось возобновить рассылку #{job[0]}: {e}")
+
+# ==== Планировщик отложенных сообщений ====
+class MessageScheduler:
+    """Отложенные сообщения из scheduled_messages на одном таймере вместо задачи на каждое."""
+
+    def __init__(self, rate: float, batch_size: int):
+        self.rate = rate
+        self.batch_size = batch_size
+        self._handlers = {}
+        # Куча (due_at, user_id, campaign)
+        self._heap = []
+        # Статусы отправленных сообщений, ещё не записанные в базу
+        self._unsaved = []
+        self._wakeup = None
+        self.bucket = None
+
+    def register(self, campaign: str, handler):
+        """handler(user_id) отправляет сообщение и возвращает статус: sent, blocked, failed или locked."""
+        self._handlers[campaign] = handler
+
+    def _push(self, due_at: float, user_id: int, campaign: str):
+        heapq.heappush(self._heap, (due_at, user_id, campaign))
+        # Будим таймер, только если новое сообщение стало ближайшим
+        if self._wakeup is not None and self._heap[0][0] == due_at:
+            self._wakeup.set()
+
+    async def schedule(self, user_id: int, campaign: str, delay: float) -> bool:
+        due_at = time.time() + delay
+        added = await db.execute(
+            'INSERT OR IGNORE INTO scheduled_messages (user_id, campaign, due_at) VALUES (?, ?, ?)',
+            (user_id, campaign, due_at)
+        )
+        if added:
+            self._push(due_at, user_id, campaign)
+        return bool(added)
+
+    async def resume(self, user_id: int, campaign: str) -> bool:
+        """Возвращает в очередь придержанное сообщение кампании, оно уйдёт сразу."""
+        due_at = time.time()
+        resumed = await db.execute(
+            "UPDATE scheduled_messages SET status = 'pending', due_at = ? "
+            "WHERE user_id = ? AND campaign = ? AND status = 'locked'",
+            (due_at, user_id, campaign)
+        )
+        if resumed:
+            self._push(due_at, user_id, campaign)
+        return bool(resumed)
+
+    async def load(self, shard: int = None, shards: int = 1):
+        """Загружает неотправленные сообщения, обработчик shard - только своих пользователей."""
+        sql = "SELECT due_at, user_id, campaign FROM scheduled_messages WHERE status = 'pending'"
+        params = ()
+        if shard is not None:
+            sql += " AND user_id % ? = ?"
+            params = (shards, shard)
+        rows = await db.fetchall(sql, params)
+        self._heap = [tuple(row) for row in rows]
+        heapq.heapify(self._heap)
+        logging.info(f"Загружено отложенных сообщений: {len(self._heap)}")
+
+    async def _deliver(self, user_id: int, campaign: str):
+        await self.bucket.acquire()
+        handler = self._handlers.get(campaign)
+        if handler is None:
+            logging.error(f"Нет обработчика для кампании {campaign}")
+            return "failed"
+        try:
+            return await handler(user_id)
+        except TelegramRetryAfter as e:
+            logging.warning(f"Telegram просит подождать {e.retry_after} сек., отправка отложена")
+            self.bucket.pause(e.retry_after)
+            self._push(time.time() + e.retry_after, user_id, campaign)
+            return None
+
+    async def _dispatch(self, batch: list):
+        # Недоступным пользователям не отправляем, статус skipped
+        blocked = await filter_blocked([user_id for _, user_id, _ in batch])
+        self._unsaved += [("skipped", user_id, campaign) for _, user_id, campaign in batch if user_id in blocked]
+
+        async def deliver(user_id: int, campaign: str):
+            # Статус запоминается сразу после отправки, даже если остальные ещё идут
+            status = await self._deliver(user_id, campaign)
+            if status is not None:
+                self._unsaved.append((status, user_id, campaign))
+
+        await asyncio.gather(*(
+            deliver(user_id, campaign) for _, user_id, campaign in batch if user_id not in blocked
+        ))
+        await self.flush()
+
+    async def flush(self):
+        # Не сохранённые статусы остаются в памяти и записываются при следующей попытке,
+        # иначе после перезапуска отправленное сообщение ушло бы повторно
+        if not self._unsaved:
+            return
+        done, self._unsaved = self._unsaved, []
+
+        def _save_scheduled_statuses(conn):
+            with conn:
+                conn.executemany(
+                    'UPDATE scheduled_messages SET status = ? WHERE user_id = ? AND campaign = ?', done
+                )
+                _bump_daily_stats(conn, date.today().isoformat(), Counter(
+                    f"{campaign}_sent" for status, _, campaign in done if status == "sent"
+                ))
+
+        try:
+            await db.run(_save_scheduled_statuses)
+        except Exception:
+            self._unsaved[:0] = done
+            raise
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            if self._unsaved:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logging.error(f"Ошибка при сохранении статусов отложенных сообщений: {e}")
+            # Пока статусы не сохранены, таймер срабатывает хотя бы раз в SCHEDULER_RETRY_INTERVAL
+            retry = SCHEDULER_RETRY_INTERVAL if self._unsaved else None
+            if not self._heap:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=retry)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                if retry:
+                    delay = min(delay, retry)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.time()
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(self._heap))
+            try:
+                await self._dispatch(batch)
+            except Exception as e:
+                logging.error(f"Ошибка при отправке отложенных сообщений: {e}")
+
+    def start(self):
+        self.bucket = TokenBucket(self.rate)
+        self._wakeup = asyncio.Event()
+        run_in_background(self.run())
+
+promo_scheduler = MessageScheduler(SCHEDULER_RATE, SCHEDULER_BATCH_SIZE)
+promo_scheduler.register(PROMO_CAMPAIGN, send_promo)
+
 # Обработчик рассылки
-@dp.message(BroadcastStates.waiting_broadcast_text)
+@dp.message(BroadcastStates.waiting_broadcast_text, F.text)
 async def process_broadcast_text(message: Message, state: FSMContext):
     if message.from_user.id != ADMIN_ID:
         return
 
-    await state.update_data(broadcast_text=message.text)
-    
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="✅ Подтвердить",
-                    callback_data="broadcast_confirm"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="◀️ Отмена",
-                    callback_data="admin_return"
-                )
-            ]
-        ]
-    )
-    
+    await state.update_data(broadcast_text=message.text, broadcast_segment="all")
+    await show_broadcast_preview(message, message.text, "all")
+
+async def show_broadcast_preview(message: Message, text: str, segment_name: str, edit: bool = False):
+    label, make_segment = BROADCAST_SEGMENTS[segment_name]
+    recipients = await count_segment(make_segment())
     preview_text = (
         "📢 <b>Предпросмотр рассылки:</b>\n\n"
-        f"{message.text}\n\n"
-        "Отправить это сообщение всем пользователям?"
+        f"{text}\n\n"
+        f"👥 Получатели: <b>{html.escape(label)}</b> - {recipients}\n\n"
+        "Отправить это сообщение?"
     )
-    
-    await message.answer(preview_text, parse_mode="HTML", reply_markup=kb)
-
-@dp.callback_query(lambda c: c.data in ["broadcast_confirm", "admin_return"])
-async def process_broadcast_confirmation(call: CallbackQuery, state: FSMContext):
+    keyboard = BROADCAST_PREVIEW_KEYBOARDS[segment_name]
+    if edit:
+        await message.edit_text(preview_text, parse_mode="HTML", reply_markup=keyboard)
+    else:
+        await message.answer(preview_text, parse_mode="HTML", reply_markup=keyboard)
+
+@dp.callback_query(BroadcastCallback.filter())
+async def process_broadcast_callback(call: CallbackQuery, callback_data: BroadcastCallback, state: FSMContext):
     if call.from_user.id != ADMIN_ID:
         await call.answer("❌ Нет доступа!", show_alert=True)
         return
 
-    try:
-        if call.data == "admin_return":
-            await state.clear()
-            await return_to_admin_panel(call.message)
-            return
-
-        elif call.data == "broadcast_confirm":
-            data = await state.get_data()
-            text_to_send = data.get("broadcast_text")
-            
-            if not text_to_send:
-                await call.message.edit_text("❌ Ошибка: текст рассылки не найден.")
-                await state.clear()
-                await asyncio.sleep(2)
-                await return_to_admin_panel(call.message)
-                return
+    action = BROADCAST_ACTIONS.get(callback_data.action)
+    if action is None:
+        await call.answer()
+        return
+    await action(call, callback_data.value, state)
 
-            users = await get_users_list()
-            if not users:
-                await call.message.edit_text("❌ Нет пользователей для рассылки.")
-                await state.clear()
-                await asyncio.sleep(2)
-                await return_to_admin_panel(call.message)
-                return
+async def select_broadcast_segment(call: CallbackQuery, segment_name: str, state: FSMContext):
+    data = await state.get_data()
+    if segment_name not in BROADCAST_SEGMENTS or not data.get("broadcast_text"):
+        await call.answer("❌ Текст рассылки не найден", show_alert=True)
+        return
 
-            sent_count = 0
-            failed_count = 0
-            blocked_count = 0
+    try:
+        await state.update_data(broadcast_segment=segment_name)
+        await show_broadcast_preview(call.message, data["broadcast_text"], segment_name, edit=True)
+        await call.answer()
+    except Exception as e:
+        logging.error(f"Ошибка при выборе сегмента рассылки: {e}")
+        await call.answer("Произошла ошибка", show_alert=True)
 
-            status_message = await call.message.edit_text("📢 Начинаю рассылку...")
+async def confirm_broadcast(call: CallbackQuery, value: str, state: FSMContext):
+    try:
+        data = await state.get_data()
+        text_to_send = data.get("broadcast_text")
 
-            for user in users:
-                user_id = user[0]
-                if await safe_send_message(user_id, text_to_send, parse_mode="HTML"):
-                    sent_count += 1
-                else:
-                    failed_count += 1
-                
-                if sent_count % 10 == 0:
-                    await status_message.edit_text(
-                        f"📢 Рассылка в процессе...\n"
-                        f"✅ Отправлено: {sent_count}\n"
-                        f"❌ Ошибок: {failed_count}\n"
-                        f"🚫 Заблокировали: {blocked_count}"
-                    )
+        if not text_to_send:
+            await call.message.edit_text("❌ Ошибка: текст рассылки не найден.")
+            await state.clear()
+            await asyncio.sleep(2)
+            await return_to_admin_panel(call.message)
+            return
 
-            await status_message.edit_text(
-                f"📢 Рассылка завершена.\n"
-                f"✅ Успешно отправлено: {sent_count}\n"
-                f"❌ Ошибок: {failed_count}\n"
-                f"🚫 Заблокировали: {blocked_count}"
-            )
+        segment = BROADCAST_SEGMENTS[data.get("broadcast_segment", "all")][1]()
+        if not await count_segment(segment):
+            await call.message.edit_text("❌ Нет пользователей для рассылки.")
             await state.clear()
-            await asyncio.sleep(3)
+            await asyncio.sleep(2)
             await return_to_admin_panel(call.message)
+            return
+
+        await state.clear()
+        job_id = await create_broadcast_job(text_to_send, "HTML", call.message, segment)
+        status_message = await call.message.edit_text(f"📢 Начинаю рассылку #{job_id}...")
+
+        # Рассылка идёт в фоне (или в процессе заданий), обработчик сразу освобождается
+        if not JOBS_IN_SEPARATE_PROCESS:
+            run_in_background(run_broadcast(job_id, text_to_send, "HTML", status_message))
 
     except Exception as e:
         logging.error(f"Ошибка при обработке рассылки: {e}")
@@ -651,39 +2644,295 @@ async def process_broadcast_confirmation(call: CallbackQuery, state: FSMContext)
         await asyncio.sleep(3)
         await return_to_admin_panel(call.message)
 
-async def safe_send_message(chat_id: int, text: str, parse_mode: str = None) -> bool:
+# Действия рассылки: BroadcastCallback.action -> обработчик(call, value, state)
+BROADCAST_ACTIONS = {
+    "segment": select_broadcast_segment,
+    "confirm": confirm_broadcast,
+}
+
+# ==== Режим webhook ====
+async def health_check(request: web.Request) -> web.Response:
+    return web.json_response({
+        "status": "ok",
+        "mode": BOT_MODE,
+        "background_tasks": len(background_tasks)
+    })
+
+def create_webhook_app() -> web.Application:
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/health", health_check)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook(stop: asyncio.Event, app: web.Application = None):
+    """Принимает обновления от Telegram через aiohttp-сервер до сигнала остановки."""
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    runner = web.AppRunner(app or create_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
     try:
-        await bot.send_message(chat_id, text, parse_mode=parse_mode)
-        return True
+        await stop.wait()
+    finally:
+        # Рассылки останавливаем до закрытия сессии, чтобы не записать их в ошибки
+        await stop_background_tasks()
+        await runner.cleanup()
+
+# ==== Метрики Prometheus ====
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE_LATEST})
+
+async def start_metrics_server():
+    """Отдаёт /metrics на отдельном локальном порту; если порт занят, бот работает без метрик."""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        logging.error(f"Не удалось запустить сервер метрик на {METRICS_HOST}:{METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# ==== Несколько процессов ====
+def update_user_id(raw: dict) -> int:
+    """id пользователя, от которого пришло обновление, или 0, если его нет."""
+    for key, payload in raw.items():
+        if key == "update_id" or not isinstance(payload, dict):
+            continue
+        if key == "chat_member":
+            # Участник канала - тот, чей статус изменился, а не тот, кто его изменил
+            return payload["new_chat_member"]["user"]["id"]
+        for name in ("from", "user", "chat"):
+            entity = payload.get(name)
+            if isinstance(entity, dict) and "id" in entity:
+                return entity["id"]
+        break
+    return 0
+
+def dispatch_update(queues: list, raw: dict):
+    """Передаёт обновление процессу, который обслуживает этого пользователя."""
+    queues[update_user_id(raw) % len(queues)].put(raw)
+
+class UserOrderedFeeder:
+    """Обрабатывает обновления параллельно, но для каждого пользователя по порядку."""
+
+    def __init__(self, concurrency: int):
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tails = {}
+
+    async def _process(self, previous: asyncio.Task, raw: dict):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await dp.feed_raw_update(bot, raw)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке обновления {raw.get('update_id')}: {e}")
+        finally:
+            self._slots.release()
+
+    async def feed(self, raw: dict):
+        await self._slots.acquire()
+        user_id = update_user_id(raw)
+        task = asyncio.create_task(self._process(self._tails.get(user_id), raw))
+        self._tails[user_id] = task
+        task.add_done_callback(lambda t: self._tails.get(user_id) is t and self._tails.pop(user_id))
+
+    async def drain(self):
+        await asyncio.gather(*self._tails.values(), return_exceptions=True)
+
+def install_worker_signals(stop: asyncio.Event):
+    # Ctrl+C приходит всей группе процессов, а дочерние останавливает основной процесс
+    signal.signal(SIGINT, signal.SIG_IGN)
+    asyncio.get_running_loop().add_signal_handler(SIGTERM, stop.set)
+
+async def start_services(role: str, shard: int = None):
+    """Запускает фоновые службы процесса с ролью single, shard или jobs."""
+    shared = role != "single"
+    event_log.shared = shared
+    event_log.rotate = role != "shard"
+    button_stats.shared = shared
+
+    activity_buffer.start()
+    event_log.start()
+    await media_cache.load()
+    await button_stats.load()
+    button_stats.start()
+
+    if role != "jobs":
+        await user_cache.load()
+        # Запускаем отложенные сообщения, в том числе просроченные за время простоя
+        await promo_scheduler.load(shard, BOT_WORKERS)
+        promo_scheduler.start()
+
+async def stop_services():
+    await stop_background_tasks()
+    try:
+        await promo_scheduler.flush()
     except Exception as e:
-        error_msg = str(e).lower()
-        if "bot was blocked by the user" in error_msg:
-            logging.warning(f"Пользователь {chat_id} заблокировал бота")
-        elif "chat not found" in error_msg:
-            logging.warning(f"Чат {chat_id} не найден")
+        logging.error(f"Ошибка при сохранении статусов отложенных сообщений: {e}")
+    await activity_buffer.flush()
+    await event_log.flush()
+    await button_stats.flush()
+    await db.close()
+    await bot.session.close()
+
+async def run_shard_worker(shard: int, queue):
+    stop = asyncio.Event()
+    install_worker_signals(stop)
+    await start_services("shard", shard)
+    feeder = UserOrderedFeeder(WORKER_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    logging.info(f"Обработчик #{shard} запущен")
+    try:
+        while not stop.is_set():
+            try:
+                raw = await loop.run_in_executor(None, queue.get, True, 1)
+            except Empty:
+                continue
+            if raw is None:
+                break
+            await feeder.feed(raw)
+        await feeder.drain()
+    finally:
+        await stop_services()
+        logging.info(f"Обработчик #{shard} остановлен")
+
+def shard_worker_main(shard: int, queue):
+    asyncio.run(run_shard_worker(shard, queue))
+
+async def run_jobs_worker():
+    """Выполняет рассылки и отчёты, поставленные обработчиками в базу."""
+    stop = asyncio.Event()
+    install_worker_signals(stop)
+    await start_services("jobs")
+    requeued = await requeue_report_jobs()
+    if requeued:
+        logging.info(f"Возвращено в очередь прерванных отчётов: {requeued}")
+    broadcasts = {}
+    logging.info("Процесс заданий запущен")
+    try:
+        while not stop.is_set():
+            try:
+                for job in await get_unfinished_broadcast_jobs():
+                    task = broadcasts.get(job[0])
+                    if task is None or task.done():
+                        logging.info(f"Запускаю рассылку #{job[0]}")
+                        broadcasts[job[0]] = await start_broadcast_job(*job)
+                for job_id, report_format, chat_id, message_id in await claim_report_jobs():
+                    logging.info(f"Запускаю отчёт #{job_id}")
+                    run_in_background(run_report_job(job_id, report_format, job_status_message(chat_id, message_id)))
+            except Exception as e:
+                logging.error(f"Ошибка в процессе заданий: {e}")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=JOBS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await stop_services()
+        logging.info("Процесс заданий остановлен")
+
+def jobs_worker_main():
+    asyncio.run(run_jobs_worker())
+
+async def poll_updates(stop: asyncio.Event, queues: list):
+    """getUpdates в основном процессе с раздачей обновлений обработчикам."""
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    stopped = asyncio.create_task(stop.wait())
+    try:
+        while True:
+            request = asyncio.create_task(bot.get_updates(
+                offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates
+            ))
+            await asyncio.wait([request, stopped], return_when=asyncio.FIRST_COMPLETED)
+            if not request.done():
+                request.cancel()
+                break
+            try:
+                updates = request.result()
+            except Exception as e:
+                logging.error(f"Ошибка при получении обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                dispatch_update(queues, update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+        # Подтверждаем полученные обновления, чтобы после перезапуска они не пришли снова
+        if offset is not None:
+            await bot.get_updates(offset=offset, timeout=0, limit=1)
+    finally:
+        stopped.cancel()
+
+def create_router_app(queues: list) -> web.Application:
+    async def handle_update(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if WEBHOOK_SECRET and not secrets.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=401)
+        dispatch_update(queues, await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.router.add_get("/health", health_check)
+    return app
+
+async def run_router(stop: asyncio.Event):
+    """Получает обновления и распределяет их по user_id между BOT_WORKERS процессами."""
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(BOT_WORKERS)]
+    shards = [
+        ctx.Process(target=shard_worker_main, args=(n, queue), name=f"bot-shard-{n}")
+        for n, queue in enumerate(queues)
+    ]
+    jobs = ctx.Process(target=jobs_worker_main, name="bot-jobs")
+    for process in shards + [jobs]:
+        process.start()
+    logging.info(f"Запущено обработчиков: {BOT_WORKERS}")
+
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(stop, create_router_app(queues))
         else:
-            logging.error(f"Ошибка при отправке сообщения пользователю {chat_id}: {e}")
-        return False
+            await poll_updates(stop, queues)
+    finally:
+        # Обработчики доделывают уже полученные обновления, рассылки сохраняют прогресс
+        for queue in queues:
+            queue.put(None)
+        jobs.terminate()
+        loop = asyncio.get_running_loop()
+        for process in shards + [jobs]:
+            await loop.run_in_executor(None, process.join)
+            metrics.mark_process_dead(process.pid)
 
 async def main():
     try:
+        if BOT_MODE == "webhook" and not WEBHOOK_URL:
+            raise ValueError("Для режима webhook укажите WEBHOOK_URL в файле .env")
+
         # Создаем директорию для файлов, если она не существует
         os.makedirs(DATA_DIR, exist_ok=True)
         
-        # Инициализируем базу данных
-        init_db()
-        
-        # Проверяем наличие необходимых файлов
-        for file_path in [LOGS_FILE, USERS_FILE, STATS_FILE]:
-            if not os.path.exists(file_path):
-                logging.info(f"Создаю файл {os.path.basename(file_path)}")
-                async with aiofiles.open(file_path, "w", encoding="utf-8") as f:
-                    if file_path == LOGS_FILE:
-                        await f.write("{}")
-                    elif file_path == USERS_FILE:
-                        await f.write("[]")
-                    elif file_path == STATS_FILE:
-                        await f.write("{}")
+        # Инициализируем базу данных и переносим данные из старых JSON-файлов
+        await init_db()
+        await migrate_legacy_files()
 
         # Проверяем подключение к Telegram
         try:
@@ -708,11 +2957,30 @@ async def main():
                 signal, lambda s=signal: asyncio.create_task(shutdown(s))
             )
             
+        metrics_runner = await start_metrics_server()
         try:
-            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+            if BOT_WORKERS > 1:
+                await run_router(stop)
+            else:
+                await start_services("single")
+                # Продолжаем рассылки, прерванные предыдущей остановкой
+                await resume_broadcasts()
+
+                if BOT_MODE == "webhook":
+                    await run_webhook(stop)
+                else:
+                    # Вебхук, оставшийся от запуска в режиме webhook, мешает getUpdates
+                    await bot.delete_webhook()
+                    await dp.start_polling(
+                        bot,
+                        allowed_updates=dp.resolve_used_update_types(),
+                        close_bot_session=False
+                    )
         finally:
             logging.info("Останавливаю бота...")
-            await bot.session.close()
+            if metrics_runner:
+                await metrics_runner.cleanup()
+            await stop_services()
             
     except Exception as e:
         logging.error(f"Критическая ошибка: {e}")
@@ -0,0 +1,69 @@
+"""Метрики бота в формате Prometheus.
+
+При BOT_WORKERS > 1 каждый процесс пишет значения в файлы каталога
+PROMETHEUS_MULTIPROC_DIR, а основной процесс отдаёт их сумму.
+"""
+import glob
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MULTIPROCESS = int(os.getenv("BOT_WORKERS", "1")) > 1
+if MULTIPROCESS:
+    # Каталог должен быть задан до импорта prometheus_client
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join("data", "metrics"))
+    if multiprocessing.current_process().name == "MainProcess":
+        # Значения прошлого запуска удаляет основной процесс, до запуска обработчиков.
+        # Каталог задаёт оператор, поэтому удаляются только файлы prometheus_client
+        os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+        for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+            os.remove(path)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+
+# Обработка обновлений
+UPDATES = Counter("bot_updates_total", "Полученные обновления", ["type"])
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Время работы обработчика", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения, вышедшие из обработчика", ["handler"])
+THROTTLED = Counter("bot_throttled_total", "События, отброшенные защитой от флуда", ["handler"])
+SUBSCRIPTION_CHECKS = Counter("bot_subscription_checks_total", "Проверки подписки на канал по результату", ["result"])
+LOGGED_ERRORS = Counter("bot_logged_errors_total", "Записи уровня ERROR в логе")
+
+# Запросы к Bot API
+API_LATENCY = Histogram("bot_api_request_duration_seconds", "Время запроса к Bot API", ["method"])
+API_ERRORS = Counter("bot_api_errors_total", "Ошибки запросов к Bot API", ["method", "error"])
+API_RETRY_AFTER = Counter("bot_api_retry_after_total", "Ответы 429 с требованием подождать", ["method"])
+
+# База данных
+DB_LATENCY = Histogram(
+    "bot_db_query_duration_seconds",
+    "Время запроса к базе вместе с ожиданием в очереди потока",
+    ["operation"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+
+# Рассылки
+BROADCAST_MESSAGES = Counter("bot_broadcast_messages_total", "Сообщения рассылок по результату", ["status"])
+BROADCAST_RETRIES = Counter("bot_broadcast_retries_total", "Повторные попытки отправки в рассылках")
+
+def render() -> bytes:
+    """Текущие значения в текстовом формате Prometheus."""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+def mark_process_dead(pid: int):
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
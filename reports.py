@@ -0,0 +1,136 @@
+"""Отчёты по пользователям бота; функции синхронные и выполняются в рабочем потоке."""
+import csv
+import gzip
+import io
+import itertools
+import sqlite3
+
+import xlsxwriter
+
+# Отчёты читают базу порциями, ширина колонок считается по первым строкам
+REPORT_CHUNK_SIZE = 1000
+REPORT_WIDTH_SAMPLE = 1000
+
+REPORT_COLUMNS = ['ID', 'Username', 'Имя', 'Фамилия', 'Дата регистрации', 'Последняя активность']
+# Лист сводки по дням: метрика таблицы daily_stats и заголовок колонки
+DAILY_COLUMNS = [
+    ('new_users', 'Новые'),
+    ('active_users', 'Активные'),
+    ('promo_sent', 'Промокоды'),
+    ('clickers', 'Нажали кнопку'),
+]
+
+def _open_report_cursor(db_file: str):
+    # Отдельное соединение только для чтения: в режиме WAL оно не мешает записи бота
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    cursor = conn.execute('''SELECT user_id, username, first_name, last_name, joined_date, last_activity
+                            FROM users ORDER BY joined_date DESC''')
+    return conn, cursor
+
+def _report_rows(cursor, progress=None):
+    """Строки отчёта из курсора порциями по REPORT_CHUNK_SIZE, с вызовом progress(count)."""
+    count = 0
+    while True:
+        rows = cursor.fetchmany(REPORT_CHUNK_SIZE)
+        if not rows:
+            return
+        if progress:
+            progress(count)
+        count += len(rows)
+        for user_id, username, first_name, last_name, joined_date, last_activity in rows:
+            yield (
+                user_id,
+                f"@{username}" if username else 'нет',
+                first_name or 'нет',
+                last_name or 'нет',
+                joined_date,
+                last_activity
+            )
+
+def _daily_rows(conn):
+    """Сводка по дням из daily_stats и button_clicks, новые дни первыми."""
+    stats = {}
+    for day, metric, value in conn.execute('SELECT day, metric, value FROM daily_stats'):
+        stats.setdefault(day, {})[metric] = value
+    for day, clicks in conn.execute('SELECT day, SUM(clicks) FROM button_clicks GROUP BY day'):
+        stats.setdefault(day, {})['clicks'] = clicks
+    for day in sorted(stats, reverse=True):
+        yield [day] + [stats[day].get(metric, 0) for metric, _ in DAILY_COLUMNS] + [stats[day].get('clicks', 0)]
+
+def _write_daily_sheet(workbook, conn, header_format, cell_format):
+    worksheet = workbook.add_worksheet('По дням')
+    titles = ['День'] + [title for _, title in DAILY_COLUMNS] + ['Нажатий']
+    for col_num, title in enumerate(titles):
+        worksheet.set_column(col_num, col_num, max(len(title), 10) + 2)
+        worksheet.write(0, col_num, title, header_format)
+    for row_num, row in enumerate(_daily_rows(conn), start=1):
+        worksheet.write_row(row_num, 0, row, cell_format)
+
+def write_excel_report(db_file: str, path: str, progress=None) -> int:
+    conn, cursor = _open_report_cursor(db_file)
+    try:
+        rows = _report_rows(cursor, progress)
+        # Ширина колонок считается по первым строкам, остальные пишутся потоком
+        sample = list(itertools.islice(rows, REPORT_WIDTH_SAMPLE))
+        if not sample:
+            return 0
+
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Пользователи')
+
+        # Форматирование заголовков
+        header_format = workbook.add_format({
+            'bold': True,
+            'text_wrap': True,
+            'valign': 'top',
+            'fg_color': '#D7E4BC',
+            'border': 1
+        })
+
+        # Форматирование ячеек
+        cell_format = workbook.add_format({
+            'text_wrap': True,
+            'valign': 'top',
+            'border': 1
+        })
+
+        for col_num, title in enumerate(REPORT_COLUMNS):
+            max_length = max([len(title)] + [len(str(row[col_num] or '')) for row in sample])
+            worksheet.set_column(col_num, col_num, max_length + 2)
+            worksheet.write(0, col_num, title, header_format)
+
+        count = 0
+        for count, row in enumerate(itertools.chain(sample, rows), start=1):
+            worksheet.write_row(count, 0, row, cell_format)
+
+        _write_daily_sheet(workbook, conn, header_format, cell_format)
+        workbook.close()
+        return count
+    finally:
+        conn.close()
+
+def write_csv_report(db_file: str, path: str, progress=None) -> int:
+    conn, cursor = _open_report_cursor(db_file)
+    try:
+        count = 0
+        # utf-8-sig, чтобы Excel правильно открыл кириллицу. Без имени и времени
+        # в заголовке gzip одинаковые данные дают одинаковый файл
+        with open(path, "wb") as raw, \
+                gzip.GzipFile(filename="", fileobj=raw, mode="wb", mtime=0) as gz, \
+                io.TextIOWrapper(gz, encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT_COLUMNS)
+            for count, row in enumerate(_report_rows(cursor, progress), start=1):
+                writer.writerow(row)
+        return count
+    finally:
+        conn.close()
+
+REPORT_WRITERS = {
+    "xlsx": write_excel_report,
+    "csv": write_csv_report,
+}
+
+def write_report(report_format: str, db_file: str, path: str, progress=None) -> int:
+    """Пишет отчёт в path и возвращает число выгруженных пользователей."""
+    return REPORT_WRITERS[report_format](db_file, path, progress)